@@ -1,14 +1,32 @@
 # --- main_app.py ---
 
 import os
+import re
+import logging
 import tempfile
 import shutil
 import requests
-from flask import Flask, render_template, request, send_from_directory, flash, redirect, url_for, session, jsonify
+from flask import Flask, render_template, request, send_file, flash, redirect, url_for, session, jsonify, Response, stream_with_context
 from pathlib import Path
 from werkzeug.utils import secure_filename
 from threading import Thread
+import threading
 import uuid
+import json
+import time
+import hashlib
+import multiprocessing
+import random
+import argparse
+import sqlite3
+import copy
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from collections import Counter, deque
+from urllib.parse import urlparse, quote
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
 
 # Attempt to import PDF libraries
 try:
@@ -24,13 +42,87 @@ except ImportError:
     PdfReader = None
     PdfWriter = None
 
+try:
+    from pdfminer.high_level import extract_pages
+    from pdfminer.layout import LTTextContainer, LTTextLine
+    logging.getLogger('pdfminer').setLevel(logging.ERROR)
+except ImportError:
+    print("WARNING: pdfminer.six not found. Topical generation will classify whole pages: pip install pdfminer.six")
+    extract_pages = None
+
 # --- Configuration ---
 app = Flask(__name__)
-app.config['SECRET_KEY'] = os.urandom(24)
+# Set SECRET_KEY when running several worker processes so they all accept the same session cookie
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY') or os.urandom(24)
 app.config['GENERATED_FILE_DIR'] = os.path.join(tempfile.gettempdir(), 'past_paper_generator')
 os.makedirs(app.config['GENERATED_FILE_DIR'], exist_ok=True)
-
-tasks_status = {}
+app.config['PAPER_BASE_URL'] = "https://bestexamhelp.com/exam/cambridge-international-a-level"
+app.config['PAPER_MIRROR_DIR'] = None
+app.config['PAPER_SOURCES'] = None
+app.config['DOWNLOAD_WORKERS'] = 8
+app.config['DOWNLOAD_MAX_PER_HOST'] = 4
+app.config['DOWNLOAD_TIMEOUT'] = 30
+app.config['DOWNLOAD_RETRIES'] = 3
+app.config['DOWNLOAD_BACKOFF_BASE'] = 0.5
+app.config['DOWNLOAD_BACKOFF_MAX'] = 30
+app.config['DOWNLOAD_CHUNK_SIZE'] = 64 * 1024
+app.config['MAX_PAPER_BYTES'] = 50 * 1024 * 1024
+app.config['ANALYSIS_WORKERS'] = 2
+app.config['TEXT_EXTRACT_WORKERS'] = os.cpu_count() or 1
+app.config['TEXT_EXTRACT_MIN_PAGES_PER_WORKER'] = 20
+app.config['TOPIC_SCORE_THRESHOLD'] = 1.0
+app.config['TOPIC_MAX_PER_QUESTION'] = 3
+app.config['KEYWORD_HIT_CAP'] = 3
+app.config['TOPICAL_OUTPUT_MODE'] = 'separate'
+app.config['TOPICAL_SKIP_MERGED_QP'] = True
+app.config['LAZY_ARTIFACTS'] = True
+app.config['PAPER_CACHE_DIR'] = os.path.join(tempfile.gettempdir(), 'past_paper_cache')
+app.config['PAPER_CACHE_MAX_BYTES'] = 2 * 1024 * 1024 * 1024
+app.config['PAPER_CACHE_REVALIDATE_AFTER'] = 7 * 24 * 3600
+app.config['MISSING_PAPER_TTL'] = 7 * 24 * 3600
+app.config['MISSING_PAPER_MANIFEST'] = None
+app.config['TOPICAL_LIBRARY_DIR'] = os.path.join(tempfile.gettempdir(), 'past_paper_library')
+app.config['TASK_STORE'] = 'sqlite'
+app.config['TASK_STORE_PATH'] = os.path.join(app.config['GENERATED_FILE_DIR'], 'tasks.sqlite3')
+app.config['TASK_PROGRESS_FLUSH_INTERVAL'] = 1.0
+app.config['TASK_ERROR_LOG_SIZE'] = 50
+app.config['TASK_STALE_AFTER'] = 300
+app.config['TASK_RECOVERY_INTERVAL'] = 60
+app.config['STATUS_STREAM_POLL_INTERVAL'] = 1.0
+app.config['STATUS_STREAM_KEEPALIVE'] = 15
+app.config['STATUS_STREAM_MAX_DURATION'] = 300
+app.config['JOB_WORKERS'] = 2
+app.config['JOB_QUEUE_MAX'] = 20
+app.config['JOB_QUEUE_MAX_PER_CLIENT'] = 3
+app.config['TASK_REUSE_WINDOW'] = 3600
+app.config['TASK_TTL'] = 24 * 3600
+app.config['TASK_DISK_HIGH_WATERMARK'] = 0.90
+app.config['TASK_DISK_LOW_WATERMARK'] = 0.80
+app.config['JANITOR_INTERVAL'] = 300
+app.config['USE_X_SENDFILE'] = False
+app.config['X_ACCEL_REDIRECT_PREFIX'] = None
+
+_task_store = None
+_task_store_lock = threading.Lock()
+_task_recovery_thread = None
+_janitor_thread = None
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+_http_session = None
+_http_lock = threading.Lock()
+_host_semaphores = {}
+
+_paper_cache_lock = threading.Lock()
+_paper_cache_index = None
+
+_mirror_digests = {}
+
+_text_extract_pool = None
+_text_extract_pool_lock = threading.Lock()
+
+_artifact_locks = {}
+_artifact_locks_lock = threading.Lock()
 
 SUBJECT_NAMES = {
     "9701": "chemistry",
@@ -347,321 +439,2693 @@ ALL_KEYWORD_MAPS = {
     }
 }
 
-def run_download_and_merge(task_id, subject_code, paper_number, start_year, end_year, sessions, include_ms):
-    tasks_status[task_id] = {'status': 'Processing', 'progress': 'Starting download/merge...', 'files': {}, 'errors': []}
+def get_http_session():
+    global _http_session
+    with _http_lock:
+        if _http_session is None:
+            pool_size = max(app.config['DOWNLOAD_WORKERS'], app.config['DOWNLOAD_MAX_PER_HOST'])
+            http_session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+            http_session.mount('https://', adapter)
+            http_session.mount('http://', adapter)
+            _http_session = http_session
+        return _http_session
+
+def get_host_semaphore(url):
+    host = urlparse(url).netloc
+    with _http_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.BoundedSemaphore(max(1, app.config['DOWNLOAD_MAX_PER_HOST']))
+        return _host_semaphores[host]
+
+TASK_FIELDS = ('status', 'progress', 'params', 'files', 'queue_position', 'stage', 'counters', 'metrics')
+TASK_JSON_FIELDS = ('params', 'files', 'counters', 'metrics')
+TASK_RUNNING_STATUSES = ('Queued', 'Processing')
+TASK_TERMINAL_STATUSES = ('Completed', 'Error', 'Cancelled')
+
+class TaskStore:
+    """Interface for task records.
+
+    A record holds 'status', 'progress', 'params', 'files', 'queue_position'
+    (None unless the task is waiting in a scheduler queue), 'stage' and
+    'counters' ({stage: {'done': n, 'total': m}}), 'metrics' (timings and
+    event counts, written when the task finishes), 'version' (bumped by every
+    change), 'error_counts' ({kind: n}), 'error_seq' (the sequence number of
+    the latest error) and 'errors'. Only the last error_log_size errors are
+    kept as {'seq', 'kind', 'message'} entries; the counts cover all of them.
+    get() returns a detached snapshot; all writes go through the methods below
+    so that every backend can be shared between threads (and, for persistent
+    backends, between worker processes).
+    """
+
+    def __init__(self, error_log_size=50):
+        self.error_log_size = max(1, error_log_size)
+        self._watchers_lock = threading.Lock()
+        self._watchers = {}
+
+    def _notify_change(self, task_id):
+        with self._watchers_lock:
+            watcher = self._watchers.get(task_id)
+        if watcher is not None:
+            with watcher['changed']:
+                watcher['changed'].notify_all()
+
+    def wait_for_change(self, task_id, timeout):
+        """Blocks until this process changes task_id or timeout seconds pass. Changes made
+        by other processes are only seen by reading again after the timeout."""
+        with self._watchers_lock:
+            watcher = self._watchers.setdefault(task_id, {'changed': threading.Condition(), 'waiting': 0})
+            watcher['waiting'] += 1
+        try:
+            with watcher['changed']:
+                watcher['changed'].wait(timeout)
+        finally:
+            with self._watchers_lock:
+                watcher['waiting'] -= 1
+                if not watcher['waiting']:
+                    del self._watchers[task_id]
+
+    def create(self, task_id, status, progress, params):
+        raise NotImplementedError
+
+    def attach_or_create(self, task_id, status, progress, params, fingerprint, completed_since, client=None):
+        """Returns the id of a queued/running task with this fingerprint, or one completed after
+        completed_since, adding client to its subscribers; otherwise creates task_id and returns it."""
+        raise NotImplementedError
+
+    def detach(self, task_id, client):
+        """Removes client from the task's subscribers and returns how many remain. Detaching a
+        client that is not subscribed changes nothing."""
+        raise NotImplementedError
+
+    def get(self, task_id, include_errors=True):
+        raise NotImplementedError
+
+    def get_errors(self, task_id, since=0):
+        """Returns the kept errors with a sequence number above since, oldest first."""
+        record = self.get(task_id)
+        return [error for error in record['errors'] if error['seq'] > since] if record else []
+
+    def get_status(self, task_id):
+        record = self.get(task_id)
+        return record['status'] if record else None
+
+    def exists(self, task_id):
+        return self.get_status(task_id) is not None
+
+    def update(self, task_id, **fields):
+        raise NotImplementedError
+
+    def start(self, task_id, **fields):
+        """Sets status to Processing along with fields unless the task was cancelled; returns whether it did."""
+        raise NotImplementedError
+
+    def set_progress(self, task_id, progress, stage=None, done=None, total=None):
+        """Sets the progress message and, when given, the current stage and its done/total counter."""
+        raise NotImplementedError
+
+    def add_error(self, task_id, message, kind='error'):
+        raise NotImplementedError
+
+    def clear_errors(self, task_id):
+        """Drops the kept errors and their counts; sequence numbers keep increasing."""
+        raise NotImplementedError
+
+    def update_files(self, task_id, files):
+        raise NotImplementedError
+
+    def update_file_record(self, task_id, file_key, changes, index=None):
+        raise NotImplementedError
+
+    def delete(self, task_id):
+        raise NotImplementedError
+
+    def finished_tasks(self):
+        """Returns [(task_id, updated_at)] for Completed, Error and Cancelled tasks, oldest first."""
+        raise NotImplementedError
+
+    def claim_stale_tasks(self, stale_after):
+        """Marks running tasks not written for stale_after seconds as Queued and returns [(task_id, params)]."""
+        return []
+
+    def flush(self):
+        """Writes any progress that set_progress() is holding back."""
+        pass
+
+class MemoryTaskStore(TaskStore):
+    """Process-local store. Records are lost on restart and are not shared between workers."""
+
+    def __init__(self, error_log_size=50):
+        super().__init__(error_log_size)
+        self._tasks = {}
+        self._meta = {}
+        self._lock = threading.Lock()
+
+    def _create(self, task_id, status, progress, params, fingerprint=None, client=None):
+        self._tasks[task_id] = {
+            'status': status, 'progress': progress, 'params': params or {}, 'files': {}, 'queue_position': None,
+            'stage': None, 'counters': {}, 'metrics': {}, 'version': 0, 'error_counts': {}, 'error_seq': 0, 'errors': [],
+        }
+        self._meta[task_id] = {
+            'fingerprint': fingerprint, 'subscribers': {client} if client else set(), 'created_at': time.time(), 'updated_at': time.time()
+        }
+
+    def create(self, task_id, status, progress, params):
+        with self._lock:
+            self._create(task_id, status, progress, params)
+
+    def attach_or_create(self, task_id, status, progress, params, fingerprint, completed_since, client=None):
+        with self._lock:
+            matches = [
+                existing_id for existing_id, meta in self._meta.items()
+                if meta['fingerprint'] == fingerprint and (
+                    self._tasks[existing_id]['status'] in TASK_RUNNING_STATUSES
+                    or (self._tasks[existing_id]['status'] == 'Completed' and meta['updated_at'] >= completed_since)
+                )
+            ]
+            if matches:
+                existing_id = max(matches, key=lambda match: self._meta[match]['created_at'])
+                if client:
+                    self._meta[existing_id]['subscribers'].add(client)
+                return existing_id
+            self._create(task_id, status, progress, params, fingerprint, client)
+            return task_id
+
+    def detach(self, task_id, client):
+        with self._lock:
+            meta = self._meta.get(task_id)
+            if meta is None:
+                return 0
+            meta['subscribers'].discard(client)
+            return len(meta['subscribers'])
+
+    def get(self, task_id, include_errors=True):
+        with self._lock:
+            record = self._tasks.get(task_id)
+            if record is None:
+                return None
+            if not include_errors:
+                record = {name: value for name, value in record.items() if name != 'errors'}
+            return copy.deepcopy(record)
+
+    def _changed_record(self, task_id):
+        record = self._tasks.get(task_id)
+        if record is not None:
+            record['version'] += 1
+            self._meta[task_id]['updated_at'] = time.time()
+        return record
+
+    def update(self, task_id, **fields):
+        with self._lock:
+            if task_id in self._tasks and not fields:
+                self._meta[task_id]['updated_at'] = time.time()
+            elif fields:
+                record = self._changed_record(task_id)
+                if record is not None:
+                    record.update({name: value for name, value in fields.items() if name in TASK_FIELDS})
+        self._notify_change(task_id)
+
+    def start(self, task_id, **fields):
+        with self._lock:
+            record = self._tasks.get(task_id)
+            if record is None or record['status'] == 'Cancelled':
+                return False
+            self._changed_record(task_id)
+            record.update({name: value for name, value in fields.items() if name in TASK_FIELDS}, status='Processing')
+        self._notify_change(task_id)
+        return True
+
+    def set_progress(self, task_id, progress, stage=None, done=None, total=None):
+        with self._lock:
+            record = self._changed_record(task_id)
+            if record is not None:
+                record['progress'] = progress
+                if stage is not None:
+                    record['stage'] = stage
+                    if total is not None:
+                        record['counters'][stage] = {'done': done, 'total': total}
+        self._notify_change(task_id)
+
+    def add_error(self, task_id, message, kind='error'):
+        with self._lock:
+            record = self._changed_record(task_id)
+            if record is not None:
+                record['error_seq'] += 1
+                record['error_counts'][kind] = record['error_counts'].get(kind, 0) + 1
+                record['errors'].append({'seq': record['error_seq'], 'kind': kind, 'message': message})
+                del record['errors'][:-self.error_log_size]
+        self._notify_change(task_id)
+
+    def clear_errors(self, task_id):
+        with self._lock:
+            record = self._changed_record(task_id)
+            if record is not None:
+                record['errors'] = []
+                record['error_counts'] = {}
+        self._notify_change(task_id)
+
+    def update_files(self, task_id, files):
+        with self._lock:
+            record = self._changed_record(task_id)
+            if record is not None:
+                record['files'].update(copy.deepcopy(files))
+        self._notify_change(task_id)
+
+    def update_file_record(self, task_id, file_key, changes, index=None):
+        with self._lock:
+            file_record = self._tasks.get(task_id, {}).get('files', {}).get(file_key)
+            if file_record is not None and index is not None:
+                file_record = file_record[index] if 0 <= index < len(file_record) else None
+            if file_record is not None:
+                self._changed_record(task_id)
+                file_record.update(changes)
+        self._notify_change(task_id)
+
+    def delete(self, task_id):
+        with self._lock:
+            self._meta.pop(task_id, None)
+            return self._tasks.pop(task_id, None) is not None
+
+    def finished_tasks(self):
+        with self._lock:
+            return sorted(
+                ((task_id, self._meta[task_id]['updated_at']) for task_id, record in self._tasks.items()
+                 if record['status'] in TASK_TERMINAL_STATUSES),
+                key=lambda task: task[1]
+            )
+
+class SQLiteConnectionMixin:
+    """One WAL-mode connection per thread to the database at self.path."""
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self, write=True):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+class SQLiteTaskStore(SQLiteConnectionMixin, TaskStore):
+    """Task records in a SQLite database shared by every worker process on the host.
+
+    Progress messages and stage counters are buffered and written at most once
+    per flush interval for each task; any other write for the task carries the
+    latest ones along.
+    Every write refreshes updated_at, which claim_stale_tasks() uses to find
+    tasks whose worker has gone away.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS tasks ("
+        " task_id TEXT PRIMARY KEY, status TEXT NOT NULL, progress TEXT, params TEXT NOT NULL,"
+        " files TEXT NOT NULL, queue_position INTEGER, fingerprint TEXT,"
+        " version INTEGER NOT NULL DEFAULT 0, stage TEXT, counters TEXT NOT NULL DEFAULT '{}',"
+        " error_counts TEXT NOT NULL DEFAULT '{}', error_seq INTEGER NOT NULL DEFAULT 0, metrics TEXT NOT NULL DEFAULT '{}',"
+        " created_at REAL NOT NULL, updated_at REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS tasks_status_updated_at ON tasks (status, updated_at)",
+        "CREATE TABLE IF NOT EXISTS task_errors ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT, task_id TEXT NOT NULL, message TEXT NOT NULL, created_at REAL NOT NULL,"
+        " seq INTEGER NOT NULL DEFAULT 0, kind TEXT NOT NULL DEFAULT 'error')",
+        "CREATE TABLE IF NOT EXISTS task_subscribers (task_id TEXT NOT NULL, client TEXT NOT NULL, PRIMARY KEY (task_id, client))",
+    )
+    ADDED_COLUMNS = {
+        'tasks': {
+            'queue_position': 'INTEGER', 'fingerprint': 'TEXT',
+            'version': 'INTEGER NOT NULL DEFAULT 0', 'stage': 'TEXT', 'counters': "TEXT NOT NULL DEFAULT '{}'",
+            'error_counts': "TEXT NOT NULL DEFAULT '{}'", 'error_seq': 'INTEGER NOT NULL DEFAULT 0',
+            'metrics': "TEXT NOT NULL DEFAULT '{}'",
+        },
+        'task_errors': {'seq': 'INTEGER NOT NULL DEFAULT 0', 'kind': "TEXT NOT NULL DEFAULT 'error'"},
+    }
+    BACKFILLS = {
+        ('task_errors', 'seq'): (
+            "UPDATE task_errors SET seq = (SELECT COUNT(*) FROM task_errors AS earlier"
+            " WHERE earlier.task_id = task_errors.task_id AND earlier.id <= task_errors.id)",
+            "UPDATE tasks SET error_seq = (SELECT COUNT(*) FROM task_errors WHERE task_errors.task_id = tasks.task_id)",
+            "UPDATE tasks SET error_counts = json_object('error', error_seq) WHERE error_seq > 0",
+        ),
+    }
+    ADDED_INDEXES = (
+        "CREATE INDEX IF NOT EXISTS tasks_fingerprint ON tasks (fingerprint, created_at)",
+        "CREATE INDEX IF NOT EXISTS task_errors_task_id_seq ON task_errors (task_id, seq)",
+        "DROP INDEX IF EXISTS task_errors_task_id",
+    )
+
+    def __init__(self, path, progress_flush_interval=1.0, error_log_size=50):
+        super().__init__(error_log_size)
+        self.path = str(path)
+        self.progress_flush_interval = progress_flush_interval
+        self._local = threading.local()
+        self._pending_lock = threading.Lock()
+        self._pending_progress = {}
+        self._last_progress_write = {}
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        with self._transaction() as conn:
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+            for table, added_columns in self.ADDED_COLUMNS.items():
+                columns = {row['name'] for row in conn.execute(f"PRAGMA table_info({table})")}
+                for name, definition in added_columns.items():
+                    if name not in columns:
+                        conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+                        for statement in self.BACKFILLS.get((table, name), ()):
+                            conn.execute(statement)
+            for statement in self.ADDED_INDEXES:
+                conn.execute(statement)
+
+    def _take_pending_progress(self, task_id):
+        with self._pending_lock:
+            self._last_progress_write[task_id] = time.monotonic()
+            return self._pending_progress.pop(task_id, None) or {}
+
+    def _write_fields(self, task_id, fields, counters=None, unless_status=None):
+        """Writes fields, merging counters ({stage: counter}) into the stored counters.
+        Nothing is written when the task's status is unless_status; returns whether a row changed."""
+        assignments, values = [], []
+        for name, value in fields.items():
+            if name not in TASK_FIELDS:
+                raise ValueError(f"Unknown task field: {name}")
+            assignments.append(f"{name} = ?")
+            values.append(json.dumps(value) if name in TASK_JSON_FIELDS else value)
+        if counters:
+            assignments.append(f"counters = json_set(counters, {', '.join('?, json(?)' for _ in counters)})")
+            for stage, counter in counters.items():
+                values.extend((f'$."{stage}"', json.dumps(counter)))
+        if assignments:
+            assignments.append("version = version + 1")
+        assignments.append("updated_at = ?")
+        values.extend((time.time(), task_id))
+        condition = "task_id = ?"
+        if unless_status is not None:
+            condition += " AND status != ?"
+            values.append(unless_status)
+        with self._transaction() as conn:
+            changed = conn.execute(f"UPDATE tasks SET {', '.join(assignments)} WHERE {condition}", values).rowcount > 0
+        self._notify_change(task_id)
+        return changed
+
+    def _insert(self, conn, task_id, status, progress, params, fingerprint=None):
+        now = time.time()
+        conn.execute("DELETE FROM task_errors WHERE task_id = ?", (task_id,))
+        conn.execute("DELETE FROM task_subscribers WHERE task_id = ?", (task_id,))
+        conn.execute(
+            "INSERT OR REPLACE INTO tasks (task_id, status, progress, params, files, fingerprint, created_at, updated_at)"
+            " VALUES (?, ?, ?, ?, '{}', ?, ?, ?)",
+            (task_id, status, progress, json.dumps(params or {}), fingerprint, now, now)
+        )
+
+    def create(self, task_id, status, progress, params):
+        with self._transaction() as conn:
+            self._insert(conn, task_id, status, progress, params)
+
+    def attach_or_create(self, task_id, status, progress, params, fingerprint, completed_since, client=None):
+        placeholders = ', '.join('?' for _ in TASK_RUNNING_STATUSES)
+        with self._transaction() as conn:
+            row = conn.execute(
+                f"SELECT task_id FROM tasks WHERE fingerprint = ?"
+                f" AND (status IN ({placeholders}) OR (status = 'Completed' AND updated_at >= ?))"
+                " ORDER BY created_at DESC LIMIT 1",
+                (fingerprint, *TASK_RUNNING_STATUSES, completed_since)
+            ).fetchone()
+            if row is None:
+                self._insert(conn, task_id, status, progress, params, fingerprint)
+            else:
+                task_id = row['task_id']
+            if client:
+                conn.execute("INSERT OR IGNORE INTO task_subscribers (task_id, client) VALUES (?, ?)", (task_id, client))
+        return task_id
+
+    def detach(self, task_id, client):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM task_subscribers WHERE task_id = ? AND client = ?", (task_id, client))
+            return conn.execute("SELECT COUNT(*) FROM task_subscribers WHERE task_id = ?", (task_id,)).fetchone()[0]
+
+    def get(self, task_id, include_errors=True):
+        with self._transaction(write=False) as conn:
+            row = conn.execute(
+                "SELECT status, progress, params, files, queue_position, stage, counters, metrics, version, error_counts, error_seq"
+                " FROM tasks WHERE task_id = ?", (task_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            errors = self._select_errors(conn, task_id) if include_errors else None
+        with self._pending_lock:
+            pending = copy.deepcopy(self._pending_progress.get(task_id, {}))
+        counters = json.loads(row['counters'])
+        counters.update(pending.get('counters', {}))
+        record = {
+            'status': row['status'], 'progress': pending.get('progress', row['progress']), 'params': json.loads(row['params']),
+            'files': json.loads(row['files']), 'queue_position': row['queue_position'],
+            'stage': pending.get('stage', row['stage']), 'counters': counters, 'metrics': json.loads(row['metrics']),
+            'version': row['version'],
+            'error_counts': json.loads(row['error_counts']), 'error_seq': row['error_seq'],
+        }
+        if include_errors:
+            record['errors'] = errors
+        return record
+
+    def _select_errors(self, conn, task_id, since=0):
+        return [
+            {'seq': error_row['seq'], 'kind': error_row['kind'], 'message': error_row['message']} for error_row in
+            conn.execute("SELECT seq, kind, message FROM task_errors WHERE task_id = ? AND seq > ? ORDER BY seq", (task_id, since))
+        ]
+
+    def get_errors(self, task_id, since=0):
+        return self._select_errors(self._connection(), task_id, since)
+
+    def get_status(self, task_id):
+        row = self._connection().execute("SELECT status FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        return row[0] if row else None
+
+    def update(self, task_id, **fields):
+        pending = self._take_pending_progress(task_id)
+        pending_counters = pending.pop('counters', {})
+        for name, value in pending.items():
+            fields.setdefault(name, value)
+        if fields.get('status') not in (None, *TASK_RUNNING_STATUSES):
+            with self._pending_lock:
+                self._last_progress_write.pop(task_id, None)
+        self._write_fields(task_id, fields, None if 'counters' in fields else pending_counters)
+
+    def start(self, task_id, **fields):
+        return self._write_fields(task_id, dict(fields, status='Processing'), unless_status='Cancelled')
+
+    def set_progress(self, task_id, progress, stage=None, done=None, total=None):
+        now = time.monotonic()
+        with self._pending_lock:
+            pending = self._pending_progress.pop(task_id, None) or {'counters': {}}
+            pending['progress'] = progress
+            if stage is not None:
+                pending['stage'] = stage
+                if total is not None:
+                    pending['counters'][stage] = {'done': done, 'total': total}
+            buffered = now - self._last_progress_write.get(task_id, 0) < self.progress_flush_interval
+            if buffered:
+                self._pending_progress[task_id] = pending
+            else:
+                self._last_progress_write[task_id] = now
+        if buffered:
+            self._notify_change(task_id)
+        else:
+            counters = pending.pop('counters')
+            self._write_fields(task_id, pending, counters)
+
+    def add_error(self, task_id, message, kind='error'):
+        now = time.time()
+        count_path = f'$."{kind}"'
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE tasks SET error_seq = error_seq + 1,"
+                " error_counts = json_set(error_counts, ?, COALESCE(json_extract(error_counts, ?), 0) + 1),"
+                " version = version + 1, updated_at = ? WHERE task_id = ?",
+                (count_path, count_path, now, task_id)
+            )
+            row = conn.execute("SELECT error_seq FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+            if row is not None:
+                conn.execute(
+                    "INSERT INTO task_errors (task_id, seq, kind, message, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (task_id, row['error_seq'], kind, message, now)
+                )
+                conn.execute(
+                    "DELETE FROM task_errors WHERE task_id = ? AND seq <= ?", (task_id, row['error_seq'] - self.error_log_size)
+                )
+        self._notify_change(task_id)
+
+    def clear_errors(self, task_id):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM task_errors WHERE task_id = ?", (task_id,))
+            conn.execute("UPDATE tasks SET error_counts = '{}', version = version + 1 WHERE task_id = ?", (task_id,))
+        self._notify_change(task_id)
+
+    def _modify_files(self, task_id, modify):
+        with self._transaction() as conn:
+            row = conn.execute("SELECT files FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+            if row is None:
+                return
+            files = json.loads(row['files'])
+            modify(files)
+            conn.execute(
+                "UPDATE tasks SET files = ?, version = version + 1, updated_at = ? WHERE task_id = ?", (json.dumps(files), time.time(), task_id)
+            )
+        self._notify_change(task_id)
+
+    def update_files(self, task_id, files):
+        self._modify_files(task_id, lambda stored: stored.update(files))
+
+    def update_file_record(self, task_id, file_key, changes, index=None):
+        def modify(files):
+            file_record = files.get(file_key)
+            if file_record is not None and index is not None:
+                file_record = file_record[index] if 0 <= index < len(file_record) else None
+            if file_record is not None:
+                file_record.update(changes)
+        self._modify_files(task_id, modify)
+
+    def delete(self, task_id):
+        with self._pending_lock:
+            self._pending_progress.pop(task_id, None)
+            self._last_progress_write.pop(task_id, None)
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM task_errors WHERE task_id = ?", (task_id,))
+            conn.execute("DELETE FROM task_subscribers WHERE task_id = ?", (task_id,))
+            return conn.execute("DELETE FROM tasks WHERE task_id = ?", (task_id,)).rowcount > 0
+
+    def finished_tasks(self):
+        placeholders = ', '.join('?' for _ in TASK_TERMINAL_STATUSES)
+        rows = self._connection().execute(
+            f"SELECT task_id, updated_at FROM tasks WHERE status IN ({placeholders}) ORDER BY updated_at", TASK_TERMINAL_STATUSES
+        ).fetchall()
+        return [(row['task_id'], row['updated_at']) for row in rows]
+
+    def claim_stale_tasks(self, stale_after):
+        now = time.time()
+        placeholders = ', '.join('?' for _ in TASK_RUNNING_STATUSES)
+        with self._transaction() as conn:
+            rows = conn.execute(
+                f"SELECT task_id, params FROM tasks WHERE status IN ({placeholders}) AND updated_at < ?",
+                (*TASK_RUNNING_STATUSES, now - stale_after)
+            ).fetchall()
+            for row in rows:
+                conn.execute(
+                    "UPDATE tasks SET status = 'Queued', progress = 'Resuming interrupted task...', version = version + 1, updated_at = ?"
+                    " WHERE task_id = ?",
+                    (now, row['task_id'])
+                )
+        return [(row['task_id'], json.loads(row['params'])) for row in rows]
+
+    def flush(self):
+        now = time.time()
+        with self._pending_lock:
+            pending_progress, self._pending_progress = self._pending_progress, {}
+            for task_id in pending_progress:
+                self._last_progress_write[task_id] = now
+        for task_id, pending in pending_progress.items():
+            counters = pending.pop('counters')
+            self._write_fields(task_id, pending, counters)
+
+TASK_STORE_BACKENDS = {
+    'memory': lambda: MemoryTaskStore(app.config['TASK_ERROR_LOG_SIZE']),
+    'sqlite': lambda: SQLiteTaskStore(
+        app.config['TASK_STORE_PATH'], app.config['TASK_PROGRESS_FLUSH_INTERVAL'], app.config['TASK_ERROR_LOG_SIZE']
+    ),
+}
+
+def get_task_store():
+    global _task_store
+    with _task_store_lock:
+        if _task_store is None:
+            backend = app.config['TASK_STORE']
+            _task_store = backend if isinstance(backend, TaskStore) else TASK_STORE_BACKENDS[backend]()
+        return _task_store
+
+def record_error(task_id, message, kind='error'):
+    get_task_store().add_error(task_id, message, kind)
+
+def set_progress(task_id, progress, stage=None, done=None, total=None):
+    get_task_store().set_progress(task_id, progress, stage, done, total)
+
+class MetricsRegistry:
+    """Process-wide stage timings and event counters, rendered in the Prometheus text format.
+
+    A timing's count is in the stage's own units (pages for text_extract,
+    questions for classify, papers for fetch), so sum / count is the time per
+    unit. Every worker process keeps its own registry.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timings = {}
+        self._events = Counter()
+
+    def observe(self, stage, seconds, count=1):
+        with self._lock:
+            timing = self._timings.setdefault(stage, [0, 0.0])
+            timing[0] += count
+            timing[1] += seconds
+
+    def count(self, event, amount=1):
+        with self._lock:
+            self._events[event] += amount
+
+    def render(self, gauges):
+        with self._lock:
+            timings = sorted(self._timings.items())
+            events = sorted(self._events.items())
+        lines = [
+            "# HELP past_paper_stage_seconds Time spent in each processing stage.",
+            "# TYPE past_paper_stage_seconds summary",
+        ]
+        for stage, (count, seconds) in timings:
+            lines.append(f'past_paper_stage_seconds_sum{{stage="{stage}"}} {seconds:.6f}')
+            lines.append(f'past_paper_stage_seconds_count{{stage="{stage}"}} {count}')
+        lines += ["# HELP past_paper_events_total Cache lookups, downloaded bytes, retries and task outcomes.", "# TYPE past_paper_events_total counter"]
+        lines += [f'past_paper_events_total{{event="{event}"}} {value}' for event, value in events]
+        for name, (help_text, value) in gauges.items():
+            lines += [f"# HELP past_paper_{name} {help_text}", f"# TYPE past_paper_{name} gauge", f"past_paper_{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+_metrics = MetricsRegistry()
+_task_metrics = {}
+_task_metrics_lock = threading.Lock()
+_metrics_local = threading.local()
+
+def start_task_metrics(task_id):
+    with _task_metrics_lock:
+        _task_metrics.setdefault(task_id, {'stages': {}, 'events': {}})
+
+def finish_task_metrics(task_id):
+    """Stores the metrics collected for a task with its record and stops collecting them."""
+    with _task_metrics_lock:
+        task_metrics = _task_metrics.pop(task_id, None)
+    if task_metrics is not None:
+        for timing in task_metrics['stages'].values():
+            timing['seconds'] = round(timing['seconds'], 6)
+        get_task_store().update(task_id, metrics=task_metrics)
+
+@contextmanager
+def metrics_task(task_id):
+    """Attributes metrics recorded by this thread without a task_id (e.g. inside paper sources) to task_id."""
+    previous_task_id = getattr(_metrics_local, 'task_id', None)
+    _metrics_local.task_id = task_id
+    try:
+        yield
+    finally:
+        _metrics_local.task_id = previous_task_id
+
+def _task_metrics_for(task_id):
+    task_id = task_id if task_id is not None else getattr(_metrics_local, 'task_id', None)
+    return _task_metrics.get(task_id)
+
+def record_timing(stage, seconds, task_id=None, count=1):
+    _metrics.observe(stage, seconds, count)
+    with _task_metrics_lock:
+        task_metrics = _task_metrics_for(task_id)
+        if task_metrics is not None:
+            timing = task_metrics['stages'].setdefault(stage, {'seconds': 0.0, 'count': 0})
+            timing['seconds'] += seconds
+            timing['count'] += count
+
+def count_event(event, amount=1, task_id=None):
+    _metrics.count(event, amount)
+    with _task_metrics_lock:
+        task_metrics = _task_metrics_for(task_id)
+        if task_metrics is not None:
+            task_metrics['events'][event] = task_metrics['events'].get(event, 0) + amount
+
+@contextmanager
+def timed(stage, task_id=None, count=1):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_timing(stage, time.perf_counter() - started, task_id, count)
+
+KEYWORD_WHOLE_WORD_MAX_LENGTH = 3
+
+GENERIC_KEYWORD_WEIGHTS = {
+    "show that": 0.1, "sketch": 0.25, "range": 0.3, "field": 0.3, "table": 0.3, "record": 0.3, "cell": 0.3,
+    "series": 0.5, "plane": 0.5, "projected": 0.5, "transformation": 0.5, "equilibrium": 0.5, "moments": 0.5,
+    "resistance": 0.5, "binary": 0.5, "register": 0.5, "monitor": 0.5, "query": 0.5, "internet": 0.5,
+    "email": 0.5, "security": 0.5, "electrode": 0.5,
+}
+
+def normalize_match_text(text):
+    return re.sub(r'\s+', ' ', text.replace('\u2019', "'").lower()).strip()
+
+class KeywordMatcher:
+    def __init__(self, keyword_map):
+        self.keyword_topics = {}
+        for keyword, topic in keyword_map.items():
+            self.keyword_topics.setdefault(normalize_match_text(keyword), set()).add(topic)
+
+        self.whole_word = {
+            keyword for keyword in self.keyword_topics
+            if len(keyword) <= KEYWORD_WHOLE_WORD_MAX_LENGTH and re.match(r'\w', keyword[-1])
+        }
+        self.prefixes = {
+            keyword: [
+                other for other in self.keyword_topics
+                if other != keyword and keyword.startswith(other) and self._ends_cleanly(other, keyword)
+            ]
+            for keyword in self.keyword_topics
+        }
+
+        trie = {}
+        for keyword in self.keyword_topics:
+            node = trie
+            for char in keyword:
+                node = node.setdefault(char, {})
+            node[''] = keyword
+        self.pattern = re.compile(f"(?=({self._trie_pattern(trie, root=True)}))")
+
+    def _ends_cleanly(self, prefix, keyword):
+        return prefix not in self.whole_word or not re.match(r'\w', keyword[len(prefix)])
+
+    def _trie_pattern(self, node, root=False):
+        branches = []
+        for char, child in sorted(node.items()):
+            if char == '':
+                continue
+            leading = r'\b' if root and re.match(r'\w', char) else ''
+            branches.append(leading + re.escape(char) + self._trie_pattern(child))
+        if '' in node:
+            branches.append(r'\b' if node[''] in self.whole_word else '')
+        if len(branches) == 1:
+            return branches[0]
+        return '(?:' + '|'.join(branches) + ')'
+
+    def find_keywords(self, text):
+        hits = Counter()
+        for match in self.pattern.finditer(normalize_match_text(text)):
+            keyword = match.group(1)
+            hits[keyword] += 1
+            for prefix in self.prefixes[keyword]:
+                hits[prefix] += 1
+        return hits
+
+    def keyword_weight(self, keyword):
+        if keyword in GENERIC_KEYWORD_WEIGHTS:
+            return GENERIC_KEYWORD_WEIGHTS[keyword]
+        return 1.0 + 0.5 * keyword.count(' ')
+
+    def score_topics(self, text, hit_cap=3):
+        scores = Counter()
+        for keyword, count in self.find_keywords(text).items():
+            weight = self.keyword_weight(keyword) * min(count, hit_cap)
+            for topic in self.keyword_topics[keyword]:
+                scores[topic] += weight
+        return scores
+
+    def classify(self, text, threshold=1.0, max_topics=3, hit_cap=3):
+        scores = self.score_topics(text, hit_cap=hit_cap)
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return [topic for topic, score in ranked[:max_topics] if score >= threshold]
+
+KEYWORD_MATCHERS = {subject_code: KeywordMatcher(keyword_map) for subject_code, keyword_map in ALL_KEYWORD_MAPS.items()}
+
+def classify_question(keyword_matcher, text):
+    if not text:
+        return []
+    return keyword_matcher.classify(
+        text,
+        threshold=app.config['TOPIC_SCORE_THRESHOLD'],
+        max_topics=app.config['TOPIC_MAX_PER_QUESTION'],
+        hit_cap=app.config['KEYWORD_HIT_CAP']
+    )
+
+def _paper_cache_dir():
+    return Path(app.config['PAPER_CACHE_DIR'])
+
+def _write_json_atomic(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+class PaperCacheIndex(SQLiteConnectionMixin):
+    """Cached paper entries and known-missing papers, kept in a SQLite database
+    inside the cache directory so every worker process sharing it sees the
+    same index.
+
+    Entries from the older index.json and missing.json files are imported when
+    the database is first created.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS papers ("
+        " key TEXT PRIMARY KEY, sha256 TEXT NOT NULL, size INTEGER NOT NULL, url TEXT, etag TEXT, last_modified TEXT,"
+        " stored_at REAL NOT NULL, last_access REAL NOT NULL, validated_at REAL)",
+        "CREATE INDEX IF NOT EXISTS papers_sha256 ON papers (sha256)",
+        "CREATE INDEX IF NOT EXISTS papers_last_access ON papers (last_access)",
+        "CREATE TABLE IF NOT EXISTS missing_papers ("
+        " key TEXT NOT NULL, source TEXT NOT NULL, checked_at REAL NOT NULL, status INTEGER, PRIMARY KEY (key, source))",
+    )
+    # Source recorded for manifest entries: the paper does not exist at any source
+    ANY_SOURCE = '*'
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+        self.path = str(self.cache_dir / 'index.sqlite3')
+        self._local = threading.local()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        with self._transaction() as conn:
+            created = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'papers'").fetchone() is None
+            missing_key_columns = {row['name']: row['pk'] for row in conn.execute("PRAGMA table_info(missing_papers)")}
+            if missing_key_columns and not missing_key_columns.get('source'):
+                # Misses recorded before they were kept per source cannot be attributed; they are looked up again
+                conn.execute("DROP TABLE missing_papers")
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+            if created:
+                self._import_json_indexes(conn)
+
+    def _import_json_indexes(self, conn):
+        try:
+            with open(self.cache_dir / 'index.json') as f:
+                papers = json.load(f)
+        except (OSError, ValueError):
+            papers = {}
+        conn.executemany(
+            "INSERT OR IGNORE INTO papers (key, sha256, size, url, etag, last_modified, stored_at, last_access, validated_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(key, entry['sha256'], entry['size'], entry.get('url'), entry.get('etag'), entry.get('last_modified'),
+              entry['stored_at'], entry.get('last_access', entry['stored_at']), entry.get('validated_at'))
+             for key, entry in papers.items()]
+        )
+        try:
+            with open(self.cache_dir / 'missing.json') as f:
+                missing = json.load(f)
+        except (OSError, ValueError):
+            missing = {}
+        # missing.json only ever recorded misses from PAPER_BASE_URL or the manifest
+        base_url_source = HTTPPaperSource(app.config['PAPER_BASE_URL']).name
+        conn.executemany(
+            "INSERT OR IGNORE INTO missing_papers (key, source, checked_at, status) VALUES (?, ?, ?, ?)",
+            [(key, self.ANY_SOURCE if entry.get('source') == 'manifest' else base_url_source, entry['checked_at'], entry.get('status'))
+             for key, entry in missing.items()]
+        )
+        if papers or missing:
+            print(f"Paper cache: Imported {len(papers)} cached and {len(missing)} missing papers into '{self.path}'")
+
+    def lookup(self, key):
+        with self._transaction() as conn:
+            row = conn.execute("SELECT * FROM papers WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if not _paper_cache_blob_path(row['sha256']).is_file():
+                conn.execute("DELETE FROM papers WHERE key = ?", (key,))
+                return None
+            entry = {name: row[name] for name in row.keys() if name != 'key'}
+            entry['last_access'] = time.time()
+            conn.execute("UPDATE papers SET last_access = ? WHERE key = ?", (entry['last_access'], key))
+            return entry
+
+    def store(self, key, url, tmp_path, sha256, size, etag, last_modified, max_bytes):
+        blob_path = _paper_cache_blob_path(sha256)
+        now = time.time()
+        entry = {
+            'sha256': sha256, 'size': size, 'url': url,
+            'etag': etag, 'last_modified': last_modified,
+            'stored_at': now, 'last_access': now, 'validated_at': None,
+        }
+        # The blob is moved into place inside the transaction so a concurrent
+        # eviction cannot remove it between the move and the index insert.
+        with self._transaction() as conn:
+            if blob_path.is_file():
+                os.unlink(tmp_path)
+            else:
+                blob_path.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(tmp_path, blob_path)
+            previous = conn.execute("SELECT sha256 FROM papers WHERE key = ?", (key,)).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO papers (key, sha256, size, url, etag, last_modified, stored_at, last_access, validated_at)"
+                " VALUES (:key, :sha256, :size, :url, :etag, :last_modified, :stored_at, :last_access, :validated_at)",
+                dict(entry, key=key)
+            )
+            # A revalidation that fetched new content leaves the old blob behind
+            if previous and previous['sha256'] != sha256:
+                self._discard_unreferenced(conn, previous['sha256'])
+            self._evict(conn, max_bytes, keep_key=key)
+        return entry
+
+    def mark_validated(self, key):
+        with self._transaction() as conn:
+            conn.execute("UPDATE papers SET validated_at = ? WHERE key = ?", (time.time(), key))
+
+    def _evict(self, conn, max_bytes, keep_key=None):
+        total_bytes = conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM papers GROUP BY sha256)"
+        ).fetchone()[0]
+        if total_bytes <= max_bytes:
+            return
+
+        candidates = conn.execute(
+            "SELECT key, sha256, size FROM papers WHERE key IS NOT ? ORDER BY last_access", (keep_key,)
+        ).fetchall()
+        for row in candidates:
+            if total_bytes <= max_bytes:
+                break
+            conn.execute("DELETE FROM papers WHERE key = ?", (row['key'],))
+            if not self._discard_unreferenced(conn, row['sha256']):
+                continue
+            total_bytes -= row['size']
+            print(f"Paper cache: Evicted {row['key']} ({row['size']} bytes)")
+
+    def _discard_unreferenced(self, conn, sha256):
+        """Delete the blob and cached analysis for sha256 unless another entry still uses them."""
+        if conn.execute("SELECT 1 FROM papers WHERE sha256 = ? LIMIT 1", (sha256,)).fetchone():
+            return False
+        for path in (_paper_cache_blob_path(sha256), _paper_analysis_cache_path(self.cache_dir, sha256)):
+            try:
+                path.unlink()
+            except OSError:
+                pass
+        return True
+
+    def missing_checks(self, key):
+        """Returns {source name: checked_at} for every source that reported key missing."""
+        with self._transaction(write=False) as conn:
+            rows = conn.execute("SELECT source, checked_at FROM missing_papers WHERE key = ?", (key,)).fetchall()
+        return {row['source']: row['checked_at'] for row in rows}
+
+    def mark_missing(self, key, source, status_code):
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO missing_papers (key, source, checked_at, status) VALUES (?, ?, ?, ?)",
+                (key, source, time.time(), status_code)
+            )
+
+    def seed_missing(self, keys):
+        now = time.time()
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO missing_papers (key, source, checked_at, status) VALUES (?, ?, ?, 404)",
+                [(key, self.ANY_SOURCE, now) for key in keys]
+            )
+
+    def forget_missing(self, key, source):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM missing_papers WHERE key = ? AND source = ?", (key, source))
+
+def get_paper_cache_index():
+    global _paper_cache_index
+    cache_dir = _paper_cache_dir()
+    with _paper_cache_lock:
+        if _paper_cache_index is None or _paper_cache_index.cache_dir != cache_dir:
+            _paper_cache_index = PaperCacheIndex(cache_dir)
+            manifest_path = app.config.get('MISSING_PAPER_MANIFEST')
+            if manifest_path:
+                _seed_missing_papers(_paper_cache_index, manifest_path)
+        return _paper_cache_index
+
+def _paper_cache_blob_path(sha256):
+    return _paper_cache_dir() / 'blobs' / sha256[:2] / f"{sha256}.pdf"
+
+def paper_cache_lookup(key):
+    return get_paper_cache_index().lookup(key)
+
+def paper_cache_store(key, url, tmp_path, sha256, size, etag=None, last_modified=None):
+    return get_paper_cache_index().store(
+        key, url, tmp_path, sha256, size, etag, last_modified, app.config['PAPER_CACHE_MAX_BYTES']
+    )
+
+def paper_cache_needs_revalidation(entry):
+    revalidate_after = app.config['PAPER_CACHE_REVALIDATE_AFTER']
+    if revalidate_after is None or not (entry.get('etag') or entry.get('last_modified')):
+        return False
+    return time.time() - (entry.get('validated_at') or entry['stored_at']) >= revalidate_after
+
+def paper_cache_mark_validated(key):
+    get_paper_cache_index().mark_validated(key)
+
+def link_paper_file(source_path, dest_path):
+    try:
+        if dest_path.exists():
+            dest_path.unlink()
+        os.link(source_path, dest_path)
+    except OSError:
+        shutil.copyfile(source_path, dest_path)
+    return dest_path
+
+def link_cached_paper(entry, dest_path):
+    return link_paper_file(_paper_cache_blob_path(entry['sha256']), dest_path)
+
+def _seed_missing_papers(index, manifest_path):
+    try:
+        with open(manifest_path) as f:
+            raw = f.read()
+    except OSError as e:
+        print(f"Missing paper manifest could not be read from '{manifest_path}': {e}")
+        return 0
+    try:
+        keys = json.loads(raw)
+    except ValueError:
+        keys = [line.strip() for line in raw.splitlines() if line.strip() and not line.startswith('#')]
+
+    index.seed_missing(keys)
+    print(f"Seeded {len(keys)} known-missing papers from '{manifest_path}'")
+    return len(keys)
+
+def seed_missing_papers(manifest_path):
+    return _seed_missing_papers(get_paper_cache_index(), manifest_path)
+
+def is_known_missing(key, sources):
+    """True when the manifest lists key, or every one of sources reported it missing within MISSING_PAPER_TTL."""
+    checks = get_paper_cache_index().missing_checks(key)
+    fresh_since = time.time() - app.config['MISSING_PAPER_TTL']
+    if checks.get(PaperCacheIndex.ANY_SOURCE, 0) > fresh_since:
+        return True
+    return bool(sources) and all(checks.get(source.name, 0) > fresh_since for source in sources)
+
+def mark_missing(key, source, status_code):
+    get_paper_cache_index().mark_missing(key, source.name, status_code)
+
+def forget_missing(key, source):
+    get_paper_cache_index().forget_missing(key, source.name)
+
+class PaperSizeError(Exception):
+    pass
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(app.config['DOWNLOAD_CHUNK_SIZE']), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def stream_response_to_file(response, dest_path):
+    max_bytes = app.config['MAX_PAPER_BYTES']
+    content_length = response.headers.get('Content-Length')
+    expected_size = int(content_length) if content_length and content_length.isdigit() else None
+    if expected_size is not None and expected_size > max_bytes:
+        raise PaperSizeError(f"Content-Length {expected_size} exceeds limit of {max_bytes} bytes")
+
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(dest_path, "wb") as f:
+            for chunk in response.iter_content(chunk_size=app.config['DOWNLOAD_CHUNK_SIZE']):
+                if not chunk:
+                    continue
+                size += len(chunk)
+                if size > max_bytes:
+                    raise PaperSizeError(f"Download exceeded limit of {max_bytes} bytes")
+                digest.update(chunk)
+                f.write(chunk)
+        if expected_size is not None and not response.headers.get('Content-Encoding') and size != expected_size:
+            raise PaperSizeError(f"Received {size} bytes but Content-Length was {expected_size}")
+    except BaseException:
+        try:
+            os.unlink(dest_path)
+        except OSError:
+            pass
+        raise
+    return digest.hexdigest(), size
+
+TRANSIENT_DOWNLOAD_ERRORS = (
+    requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError,
+)
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def retry_delay(attempt, retry_after=None):
+    """Seconds to wait before retry number attempt + 1, or None if the server asked
+    for a longer pause than DOWNLOAD_BACKOFF_MAX."""
+    backoff_max = app.config['DOWNLOAD_BACKOFF_MAX']
+    retry_after_seconds = parse_retry_after(retry_after)
+    if retry_after_seconds is not None:
+        return retry_after_seconds if retry_after_seconds <= backoff_max else None
+    backoff = min(backoff_max, app.config['DOWNLOAD_BACKOFF_BASE'] * 2 ** attempt)
+    return backoff / 2 + random.uniform(0, backoff / 2)
+
+class PaperNotModified(Exception):
+    pass
+
+class PaperNotFound(Exception):
+    def __init__(self, location, status_code=404):
+        super().__init__(f"{location} not found (HTTP {status_code})")
+        self.status_code = status_code
+
+class PaperSource:
+    """Somewhere papers can be fetched from, addressed by '{subject}-{code}/{year}/{filename}'."""
+
+    cacheable = True
+
+    @property
+    def name(self):
+        """Identifies the source in the known-missing index."""
+        return self.describe('')
+
+    def describe(self, relative_path):
+        return relative_path
+
+    def fetch(self, relative_path, dest_path, cached_entry=None):
+        """Writes the paper to dest_path and returns (sha256, size, metadata).
+
+        Raises PaperNotFound when the source does not have the paper, and
+        PaperNotModified when cached_entry is still current; any other
+        exception means the source could not be reached or returned bad data.
+        """
+        raise NotImplementedError
+
+class HTTPPaperSource(PaperSource):
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def describe(self, relative_path):
+        return f"{self.base_url}/{relative_path}"
+
+    def fetch(self, relative_path, dest_path, cached_entry=None):
+        url = self.describe(relative_path)
+        headers = {}
+        if cached_entry and cached_entry.get('etag'):
+            headers['If-None-Match'] = cached_entry['etag']
+        if cached_entry and cached_entry.get('last_modified'):
+            headers['If-Modified-Since'] = cached_entry['last_modified']
+
+        retries = max(0, app.config['DOWNLOAD_RETRIES'])
+        for attempt in range(retries + 1):
+            final_attempt = attempt == retries
+            try:
+                waiting_since = time.perf_counter()
+                with get_host_semaphore(url):
+                    requested_at = time.perf_counter()
+                    record_timing('host_slot_wait', requested_at - waiting_since)
+                    with get_http_session().get(url, headers=headers, timeout=app.config['DOWNLOAD_TIMEOUT'], stream=True) as response:
+                        record_timing('http_wait', time.perf_counter() - requested_at)
+                        if response.status_code == 304 and cached_entry:
+                            raise PaperNotModified(url)
+                        if response.status_code in (404, 410):
+                            raise PaperNotFound(url, response.status_code)
+                        delay = None
+                        if response.status_code in RETRY_STATUS_CODES and not final_attempt:
+                            delay = retry_delay(attempt, response.headers.get('Retry-After'))
+                        if delay is None:
+                            response.raise_for_status()
+                            with timed('http_body'):
+                                sha256, size = stream_response_to_file(response, dest_path)
+                            count_event('bytes_downloaded', size)
+                            return sha256, size, {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+                        reason = f"HTTP {response.status_code}"
+            except TRANSIENT_DOWNLOAD_ERRORS as e:
+                if final_attempt:
+                    raise
+                delay = retry_delay(attempt)
+                reason = type(e).__name__
+            print(f"Retrying {url} in {delay:.1f}s after {reason} (attempt {attempt + 2} of {retries + 1})")
+            count_event('download_retries')
+            time.sleep(delay)
+
+class MirrorPaperSource(PaperSource):
+    """A local directory laid out like the website. Papers are linked straight into the
+    task directory rather than copied into the paper cache, and their digests are
+    remembered until the file changes."""
+
+    cacheable = False
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def describe(self, relative_path):
+        return str(self.root / relative_path)
+
+    def fetch(self, relative_path, dest_path, cached_entry=None):
+        source_path = self.root / relative_path
+        try:
+            stat = source_path.stat()
+        except FileNotFoundError:
+            raise PaperNotFound(source_path)
+        if stat.st_size > app.config['MAX_PAPER_BYTES']:
+            raise PaperSizeError(f"{stat.st_size} bytes exceeds limit of {app.config['MAX_PAPER_BYTES']} bytes")
+
+        digest_key = (str(source_path), stat.st_mtime_ns, stat.st_size)
+        sha256 = _mirror_digests.get(digest_key)
+        if sha256 is None:
+            sha256 = _mirror_digests[digest_key] = file_sha256(source_path)
+        link_paper_file(source_path, dest_path)
+        return sha256, stat.st_size, {}
+
+def paper_source_from_spec(spec):
+    if isinstance(spec, PaperSource):
+        return spec
+    if spec.startswith(('http://', 'https://')):
+        return HTTPPaperSource(spec)
+    return MirrorPaperSource(spec[len('file://'):] if spec.startswith('file://') else spec)
+
+def get_paper_sources():
+    """Sources to try in order: PAPER_SOURCES if set (URLs, mirror directories or
+    PaperSource objects), otherwise PAPER_MIRROR_DIR (if set) then PAPER_BASE_URL."""
+    specs = app.config['PAPER_SOURCES']
+    if not specs:
+        specs = [app.config['PAPER_MIRROR_DIR']] if app.config['PAPER_MIRROR_DIR'] else []
+        specs.append(app.config['PAPER_BASE_URL'])
+    return [paper_source_from_spec(spec) for spec in specs]
+
+def fetch_from_source(source, relative_path, file_filepath, partial_dir, cached_entry=None):
+    filename = file_filepath.name
+    if not source.cacheable:
+        sha256, _, _ = source.fetch(relative_path, file_filepath)
+        return sha256
+    if partial_dir is None:
+        partial_path = file_filepath.with_name(f"{filename}.part")
+        sha256, _, _ = source.fetch(relative_path, partial_path)
+        os.replace(partial_path, file_filepath)
+        return sha256
+
+    partial_path = partial_dir / f"{filename}.{uuid.uuid4().hex}.part"
+    try:
+        sha256, size, metadata = source.fetch(relative_path, partial_path, cached_entry)
+    except PaperNotModified:
+        count_event('paper_cache_revalidated')
+        paper_cache_mark_validated(filename)
+        link_cached_paper(cached_entry, file_filepath)
+        return cached_entry['sha256']
+    cached_entry = paper_cache_store(filename, source.describe(relative_path), partial_path, sha256, size, **metadata)
+    link_cached_paper(cached_entry, file_filepath)
+    return sha256
+
+def download_paper(task_id, relative_path, file_filepath):
+    with metrics_task(task_id), timed('fetch'):
+        return _download_paper(task_id, relative_path, file_filepath)
+
+def _download_paper(task_id, relative_path, file_filepath):
+    filename = file_filepath.name
+    cached_entry = paper_cache_lookup(filename)
+    if cached_entry and not paper_cache_needs_revalidation(cached_entry):
+        try:
+            link_cached_paper(cached_entry, file_filepath)
+            count_event('paper_cache_hit')
+            print(f"Task {task_id}: Cache hit: {filename}")
+            return file_filepath, cached_entry['sha256']
+        except OSError as e:
+            print(f"Task {task_id}: Could not use cached copy of {filename}: {e}")
+            cached_entry = None
+
+    sources = get_paper_sources()
+    if not cached_entry and is_known_missing(filename, sources):
+        count_event('known_missing_skipped')
+        error_msg = f"Skipped {filename}: known to be missing upstream."
+        record_error(task_id, error_msg, 'missing')
+        print(f"Task {task_id}: {error_msg}")
+        return None, None
+
+    partial_dir = _paper_cache_dir() / 'partial'
+    try:
+        partial_dir.mkdir(parents=True, exist_ok=True)
+    except OSError as e:
+        print(f"Task {task_id}: Paper cache unavailable for {filename}: {e}")
+        partial_dir = None
+
+    count_event('paper_cache_miss' if cached_entry is None else 'paper_cache_stale')
+    failures = []
+    not_found_status = None
+    source_unavailable = False
+    for source in sources:
+        location = source.describe(relative_path)
+        try:
+            print(f"Task {task_id}: Attempting download: {location}")
+            sha256 = fetch_from_source(source, relative_path, file_filepath, partial_dir, cached_entry)
+            forget_missing(filename, source)
+            print(f"Task {task_id}: Downloaded: {filename}")
+            return file_filepath, sha256
+        except PaperNotFound as e:
+            not_found_status = not_found_status or e.status_code
+            mark_missing(filename, source, e.status_code)
+            failures.append(f"Download failed for {filename} (HTTP {e.status_code}): URL={location}")
+            continue
+        except requests.exceptions.HTTPError as e:
+            failures.append(f"Download failed for {filename} (HTTP {e.response.status_code}): URL={location}")
+        except PaperSizeError as e:
+            failures.append(f"Rejected download of {filename}: {e}")
+        except requests.exceptions.RequestException as e:
+            failures.append(f"Network error downloading {filename}: {e}")
+        except Exception as e:
+            failures.append(f"Unexpected error downloading {filename} from {location}: {e}")
+        source_unavailable = True
+
+    if cached_entry:
+        try:
+            link_cached_paper(cached_entry, file_filepath)
+            count_event('paper_cache_stale_served')
+            print(f"Task {task_id}: Could not revalidate {filename}; using cached copy.")
+            return file_filepath, cached_entry['sha256']
+        except OSError as e:
+            print(f"Task {task_id}: Could not use cached copy of {filename}: {e}")
+
+    missing = not_found_status is not None and not source_unavailable
+    error_msg = failures[0] if len(failures) == 1 else f"No source could provide {filename}: " + "; ".join(failures)
+    record_error(task_id, error_msg, 'missing' if missing else 'download')
+    print(f"Task {task_id}: {error_msg}")
+    return None, None
+
+def extract_page_range(pdf_path, page_indices=None):
+    reader = PdfReader(pdf_path)
+    if page_indices is None:
+        page_indices = range(len(reader.pages))
+    extracted = []
+    for page_index in page_indices:
+        try:
+            extracted.append((page_index, reader.pages[page_index].extract_text(), None))
+        except Exception as e:
+            extracted.append((page_index, None, str(e)))
+    return extracted
+
+def extract_paper_text(pdf_path):
+    return [text for _, text, _ in extract_page_range(str(pdf_path))]
+
+QUESTION_NUMBER_PATTERN = re.compile(r'^(\d{1,2})(?=\s|\(|$)')
+QUESTION_NUMBER_MAX_X = 80
+PAGE_MARGIN_FRACTION = 0.07
+MARK_SCHEME_MAX_NUMBER_GAP = 3
+PAPER_ANALYSIS_VERSION = 3
+
+def _page_text_lines(page_layout):
+    lines = []
+    for element in page_layout:
+        if isinstance(element, LTTextContainer):
+            for line in element:
+                if isinstance(line, LTTextLine):
+                    text = line.get_text().strip()
+                    if text:
+                        lines.append((line.y1, line.x0, line.y0, text))
+    lines.sort(key=lambda line: (-line[0], line[1]))
+    return lines
+
+def segment_questions(pdf_path, mark_scheme=False):
+    page_texts = []
+    questions = []
+    current_question = None
+    last_number = 0
+
+    for page_index, page_layout in enumerate(extract_pages(pdf_path)):
+        lines = _page_text_lines(page_layout)
+        page_texts.append("\n".join(text for _, _, _, text in lines))
+        top_limit = page_layout.height * (1 - PAGE_MARGIN_FRACTION)
+        bottom_limit = page_layout.height * PAGE_MARGIN_FRACTION
+
+        for top, left, bottom, text in lines:
+            if top > top_limit or bottom < bottom_limit:
+                continue
+            marker = normalize_match_text(text)
+            if marker == 'blank page':
+                continue
+            if marker.startswith('additional page'):
+                current_question = None
+                continue
+
+            match = QUESTION_NUMBER_PATTERN.match(text)
+            number = int(match.group(1)) if match and left <= QUESTION_NUMBER_MAX_X else None
+            if mark_scheme:
+                is_new_question = number is not None and last_number < number <= last_number + MARK_SCHEME_MAX_NUMBER_GAP
+            else:
+                is_new_question = number == last_number + 1
+            if is_new_question:
+                last_number = number
+                current_question = {'number': last_number, 'pages': [page_index], 'lines': []}
+                questions.append(current_question)
+            elif current_question is not None and current_question['pages'][-1] != page_index:
+                current_question['pages'].append(page_index)
+            if current_question is not None:
+                current_question['lines'].append(text)
+
+    if questions:
+        units = [
+            {'number': question['number'], 'pages': question['pages'], 'text': "\n".join(question['lines'])}
+            for question in questions
+        ]
+    else:
+        units = [{'number': None, 'pages': [i], 'text': text} for i, text in enumerate(page_texts)]
+    return {'version': PAPER_ANALYSIS_VERSION, 'kind': 'ms' if mark_scheme else 'qp', 'page_count': len(page_texts), 'questions': units}
+
+def analyze_paper(pdf_path, kind='qp'):
+    if extract_pages is not None:
+        return segment_questions(pdf_path, mark_scheme=kind == 'ms')
+    page_texts = extract_paper_text(pdf_path)
+    return {
+        'version': PAPER_ANALYSIS_VERSION,
+        'kind': kind,
+        'page_count': len(page_texts),
+        'questions': [{'number': None, 'pages': [i], 'text': text} for i, text in enumerate(page_texts)],
+    }
+
+def _paper_analysis_cache_path(cache_dir, sha256):
+    return Path(cache_dir) / 'analysis' / sha256[:2] / f"{sha256}.json"
+
+def load_paper_analysis(pdf_path, sha256=None, cache_dir=None, kind='qp'):
+    return measure_paper_analysis(pdf_path, sha256, cache_dir, kind)[0]
+
+def measure_paper_analysis(pdf_path, sha256=None, cache_dir=None, kind='qp'):
+    """Returns (analysis, seconds spent extracting, or None for a cached analysis). Runs in the text
+    extraction pool, whose processes have their own metrics, so the caller records the timing."""
+    analysis_cache_path = _paper_analysis_cache_path(cache_dir, sha256) if sha256 and cache_dir else None
+    if analysis_cache_path:
+        try:
+            with open(analysis_cache_path) as f:
+                cached = json.load(f)
+            if cached.get('version') == PAPER_ANALYSIS_VERSION and cached.get('kind') == kind:
+                return cached, None
+        except (OSError, ValueError):
+            pass
+
+    started = time.perf_counter()
+    analysis = analyze_paper(pdf_path, kind)
+    extract_seconds = time.perf_counter() - started
+    if analysis_cache_path and all(question['text'] is not None for question in analysis['questions']):
+        try:
+            _write_json_atomic(analysis_cache_path, analysis)
+        except OSError as e:
+            print(f"Could not cache analysis for {pdf_path}: {e}")
+    return analysis, extract_seconds
+
+def get_text_extract_pool():
+    global _text_extract_pool
+    if app.config['TEXT_EXTRACT_WORKERS'] <= 1:
+        return None
+    with _text_extract_pool_lock:
+        if _text_extract_pool is None:
+            _text_extract_pool = ProcessPoolExecutor(
+                max_workers=app.config['TEXT_EXTRACT_WORKERS'],
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _text_extract_pool
+
+def _discard_text_extract_pool():
+    global _text_extract_pool
+    with _text_extract_pool_lock:
+        if _text_extract_pool is not None:
+            _text_extract_pool.shutdown(wait=False, cancel_futures=True)
+            _text_extract_pool = None
+
+def extract_pages_text(task_id, pdf_path, page_indices):
+    page_indices = list(page_indices)
+    min_chunk = max(1, app.config['TEXT_EXTRACT_MIN_PAGES_PER_WORKER'])
+    workers = min(app.config['TEXT_EXTRACT_WORKERS'], len(page_indices) // min_chunk)
+    pool = get_text_extract_pool() if workers > 1 else None
+    if pool is None:
+        with timed('text_extract', task_id, len(page_indices)):
+            return extract_page_range(str(pdf_path), page_indices)
+
+    chunk_size = -(-len(page_indices) // workers)
+    chunks = [page_indices[start:start + chunk_size] for start in range(0, len(page_indices), chunk_size)]
+    print(f"Task {task_id}: Extracting text from {len(page_indices)} pages across {len(chunks)} worker processes")
+    started = time.perf_counter()
+    try:
+        futures = [pool.submit(extract_page_range, str(pdf_path), chunk) for chunk in chunks]
+        extracted = []
+        for chunks_done, future in enumerate(futures, start=1):
+            extracted.extend(future.result())
+            progress_percent = int((chunks_done / len(chunks)) * 100)
+            set_progress(task_id, f'Extracting page text... ({progress_percent}%)', 'extract', chunks_done, len(chunks))
+        record_timing('text_extract', time.perf_counter() - started, task_id, len(page_indices))
+        return extracted
+    except BrokenProcessPool as e:
+        print(f"Task {task_id}: Text extraction pool failed ({e}). Falling back to serial extraction.")
+        _discard_text_extract_pool()
+        return extract_page_range(str(pdf_path), page_indices)
+
+def paper_download_jobs(subject_code, paper_number, years, sessions, file_types, dest_dir):
+    subject_name = SUBJECT_NAMES[subject_code]
+    download_jobs = []
+    for file_type in file_types:
+        for year in years:
+            for session in sessions:
+                variant_numbers = ["2"] if session == "m" else ["1", "2", "3"]
+                variants_full = [f"{paper_number}{v}" for v in variant_numbers]
+
+                for variant in variants_full:
+                    filename = f"{subject_code}_{session}{str(year)[-2:]}_{file_type}_{variant}.pdf"
+                    download_jobs.append({
+                        'subject_code': subject_code, 'file_type': file_type, 'year': year, 'session': session, 'variant': variant,
+                        'filename': filename,
+                        'source_path': f"{subject_name}-{subject_code}/{year}/{filename}",
+                        'path': Path(dest_dir) / filename,
+                    })
+    return download_jobs
+
+def run_download_and_merge(task_id, subject_code, paper_number, start_year, end_year, sessions, include_ms, analyze_qp=False):
+    get_task_store().clear_errors(task_id)
+    # A cancel that arrived after the scheduler picked the task up must not be overwritten
+    if not get_task_store().start(
+        task_id, progress='Starting download/merge...', files={}, queue_position=None, stage=None, counters={}
+    ):
+        raise TaskCancelled(task_id)
 
     if not PdfMerger:
-        tasks_status[task_id]['status'] = 'Error'
-        tasks_status[task_id]['errors'].append("PDF Merging library (PyPDF2) not available.")
-        return {}
+        get_task_store().update(task_id, status='Error')
+        record_error(task_id, "PDF Merging library (PyPDF2) not available.")
+        return {}, None
 
     base_dir = Path(app.config['GENERATED_FILE_DIR']) / task_id
     try:
         base_dir.mkdir(parents=True, exist_ok=True)
     except OSError as e:
-        tasks_status[task_id]['status'] = 'Error'
-        tasks_status[task_id]['errors'].append(f"Error creating temporary directory: {e}")
-        return {}
+        get_task_store().update(task_id, status='Error')
+        record_error(task_id, f"Error creating temporary directory: {e}")
+        return {}, None
 
     subject_name = SUBJECT_NAMES.get(subject_code)
     if not subject_name:
-        tasks_status[task_id]['status'] = 'Error'
-        tasks_status[task_id]['errors'].append(f"Subject URL name not found for code {subject_code}. Check SUBJECT_NAMES.")
-        return {}
+        get_task_store().update(task_id, status='Error')
+        record_error(task_id, f"Subject URL name not found for code {subject_code}. Check SUBJECT_NAMES.")
+        return {}, None
 
     years = list(range(start_year, end_year + 1))
-    base_url = "https://bestexamhelp.com/exam/cambridge-international-a-level"
+    analyze_qp = analyze_qp and PdfReader is not None
+    analyze_ms = analyze_qp and include_ms
+    defer_qp_merge = analyze_qp and app.config['TOPICAL_SKIP_MERGED_QP']
 
     results = {'qp': None, 'ms': None}
     file_types_to_process = ['qp']
     if include_ms:
         file_types_to_process.append('ms')
+    merge_file_types = [
+        file_type for file_type in file_types_to_process
+        if not app.config['LAZY_ARTIFACTS'] and not (file_type == 'qp' and defer_qp_merge)
+    ]
 
-    total_files_to_attempt = 0
-    for file_type in file_types_to_process:
-        for year in years:
-            for session in sessions:
-                variants_count = 1 if session == "m" else 3
-                total_files_to_attempt += variants_count
+    download_jobs = paper_download_jobs(subject_code, paper_number, years, sessions, file_types_to_process, base_dir)
 
+    downloaded_paths = [None] * len(download_jobs)
+    download_done = [False] * len(download_jobs)
     files_processed_count = 0
-    total_steps = total_files_to_attempt * (2 if include_ms else 1)
-
-    for file_type in file_types_to_process:
-        pdf_files_to_merge = []
-        tasks_status[task_id]['progress'] = f'Processing {file_type.upper()}...'
-        print(f"Task {task_id}: Processing {file_type.upper()}...")
+    progress_percent = 0
+    total_steps = len(download_jobs)
+    set_progress(task_id, f'Downloading {total_steps} files...', 'download', 0, total_steps)
+    print(f"Task {task_id}: Downloading {total_steps} files with {app.config['DOWNLOAD_WORKERS']} workers...")
+
+    jobs_by_type = {
+        file_type: [job_index for job_index, job in enumerate(download_jobs) if job['file_type'] == file_type]
+        for file_type in file_types_to_process
+    }
+    mergers = {file_type: PdfMerger() for file_type in merge_file_types}
+    merge_cursors = {file_type: 0 for file_type in merge_file_types}
+    merged_papers = {file_type: [] for file_type in merge_file_types}
+    analysis_futures = {}
+    analysis_args = {}
+    library_indexes = {}
+
+    def append_ready_papers():
+        for file_type in merge_file_types:
+            order = jobs_by_type[file_type]
+            merger = mergers[file_type]
+            while merge_cursors[file_type] < len(order) and download_done[order[merge_cursors[file_type]]]:
+                job_index = order[merge_cursors[file_type]]
+                merge_cursors[file_type] += 1
+                pdf_file = downloaded_paths[job_index]
+                if pdf_file is None:
+                    continue
+                pages_before = len(merger.pages)
+                try:
+                    with timed('merge', task_id):
+                        merger.append(str(pdf_file))
+                except Exception as merge_err:
+                    error_msg = f"Could not append file {pdf_file.name} to {file_type.upper()} merge: {merge_err}. Skipping."
+                    record_error(task_id, error_msg, 'merge')
+                    print(f"Task {task_id}: {error_msg}")
+                merged_papers[file_type].append((job_index, len(merger.pages) - pages_before))
 
-        for year in years:
-            for session in sessions:
-                variant_numbers = ["2"] if session == "m" else ["1", "2", "3"]
-                variants_full = [f"{paper_number}{v}" for v in variant_numbers]
+    with ThreadPoolExecutor(max_workers=max(1, app.config['DOWNLOAD_WORKERS'])) as executor, \
+            ThreadPoolExecutor(max_workers=max(1, app.config['ANALYSIS_WORKERS'])) as analysis_executor:
+        futures = {
+            executor.submit(download_paper, task_id, job['source_path'], job['path']): job_index
+            for job_index, job in enumerate(download_jobs)
+        }
+        for future in as_completed(futures):
+            if task_cancelled(task_id):
+                for pending_future in analysis_futures.values():
+                    pending_future.cancel()
+                executor.shutdown(cancel_futures=True)
+                raise TaskCancelled(task_id)
+            job_index = futures[future]
+            job = download_jobs[job_index]
+            downloaded_paths[job_index], paper_sha256 = future.result()
+            download_done[job_index] = True
+            analyze_job = analyze_qp if job['file_type'] == 'qp' else analyze_ms
+            if analyze_job and downloaded_paths[job_index] is not None:
+                if job['file_type'] == 'qp':
+                    library_indexes[job_index] = load_library_index(subject_code, job['filename'], paper_sha256)
+                else:
+                    library_indexes[job_index] = load_library_index(
+                        subject_code, question_paper_filename(job['filename']), ms_sha256=paper_sha256
+                    )
+                analysis_args[job_index] = (str(downloaded_paths[job_index]), paper_sha256, str(_paper_cache_dir()), job['file_type'])
+                if not library_indexes[job_index]:
+                    extract_executor = get_text_extract_pool() or analysis_executor
+                    analysis_futures[job_index] = extract_executor.submit(measure_paper_analysis, *analysis_args[job_index])
+            append_ready_papers()
+            files_processed_count += 1
+            progress_percent = int((files_processed_count / max(1, total_steps)) * 100)
+            set_progress(
+                task_id, f'Downloaded {job["file_type"].upper()} {job["year"]}/{job["session"]}/var{job["variant"][-1]}... ({progress_percent}%)',
+                'download', files_processed_count, total_steps
+            )
 
-                for variant in variants_full:
-                    files_processed_count += 1
-                    progress_percent = int((files_processed_count / max(1, total_steps)) * 100)
-                    tasks_status[task_id]['progress'] = f'Downloading {file_type.upper()} {year}/{session}/var{variant[-1]}... ({progress_percent}%)'
+        for file_type_index, file_type in enumerate(file_types_to_process):
+            set_progress(task_id, f'Processing {file_type.upper()}...', 'merge', file_type_index, len(file_types_to_process))
+            print(f"Task {task_id}: Processing {file_type.upper()}...")
+            output_filename = f"{subject_code}_{paper_number}_{start_year}-{end_year}_{''.join(sessions)}_{file_type}_merged.pdf"
+            output_filepath = base_dir / output_filename
 
-                    filename = f"{subject_code}_{session}{str(year)[-2:]}_{file_type}_{variant}.pdf"
-                    file_url = f"{base_url}/{subject_name}-{subject_code}/{year}/{filename}"
-                    file_filepath = base_dir / filename
+            if file_type not in merge_file_types:
+                sources = [downloaded_paths[job_index].name for job_index in jobs_by_type[file_type] if downloaded_paths[job_index] is not None]
+                if sources:
+                    results[file_type] = {'path': str(output_filepath), 'filename': output_filename, 'pending': True, 'sources': sources}
+                    print(f"Task {task_id}: Deferred merging {len(sources)} {file_type.upper()} files until first download.")
+                else:
+                    error_msg = f"No {file_type.upper()} files were successfully downloaded/found to merge."
+                    record_error(task_id, error_msg, 'merge')
+                    print(f"Task {task_id}: {error_msg}")
+                continue
 
-                    try:
-                        print(f"Task {task_id}: Attempting download: {file_url}")
-                        response = requests.get(file_url, timeout=30)
-                        response.raise_for_status()
-
-                        with open(file_filepath, "wb") as f:
-                            f.write(response.content)
-                        pdf_files_to_merge.append(file_filepath)
-                        print(f"Task {task_id}: Downloaded: {filename}")
-
-                    except requests.exceptions.HTTPError as e:
-                        error_msg = f"Download failed for {filename} (HTTP {e.response.status_code}): URL={file_url}"
-                        tasks_status[task_id]['errors'].append(error_msg)
-                        print(f"Task {task_id}: {error_msg}")
-                    except requests.exceptions.RequestException as e:
-                        error_msg = f"Network error downloading {filename}: {e}"
-                        tasks_status[task_id]['errors'].append(error_msg)
-                        print(f"Task {task_id}: {error_msg}")
-                    except Exception as e:
-                        error_msg = f"Unexpected error downloading {filename}: {e}"
-                        tasks_status[task_id]['errors'].append(error_msg)
-                        print(f"Task {task_id}: {error_msg}")
+            merger = mergers[file_type]
 
-        if pdf_files_to_merge:
-            tasks_status[task_id]['progress'] = f'Merging {len(pdf_files_to_merge)} {file_type.upper()} files... ({progress_percent}%)'
-            output_filename = f"{subject_code}_{paper_number}_{start_year}-{end_year}_{''.join(sessions)}_{file_type}_merged.pdf"
-            output_filepath = base_dir / output_filename
-            try:
-                merger = PdfMerger()
-                for pdf_file in pdf_files_to_merge:
-                    try:
-                        merger.append(str(pdf_file))
-                    except Exception as merge_err:
-                        error_msg = f"Could not append file {pdf_file.name} to {file_type.upper()} merge: {merge_err}. Skipping."
-                        tasks_status[task_id]['errors'].append(error_msg)
+            if merged_papers[file_type]:
+                set_progress(task_id, f'Writing merged {file_type.upper()} from {len(merged_papers[file_type])} files... ({progress_percent}%)')
+                try:
+                    if len(merger.pages) > 0:
+                        with timed('pdf_write', task_id):
+                            merger.write(str(output_filepath))
+                        merger.close()
+                        results[file_type] = {'path': str(output_filepath), 'filename': output_filename}
+                        print(f"Task {task_id}: Successfully merged {file_type.upper()} to {output_filename}")
+                    else:
+                        error_msg = f"No valid pages found/appended to merge for {file_type.upper()}."
+                        record_error(task_id, error_msg, 'merge')
                         print(f"Task {task_id}: {error_msg}")
+                        if file_type in results: del results[file_type]
 
-                if len(merger.pages) > 0:
-                    merger.write(str(output_filepath))
-                    merger.close()
-                    results[file_type] = {'path': str(output_filepath), 'filename': output_filename}
-                    print(f"Task {task_id}: Successfully merged {file_type.upper()} to {output_filename}")
-                else:
-                    error_msg = f"No valid pages found/appended to merge for {file_type.upper()}."
-                    tasks_status[task_id]['errors'].append(error_msg)
+                except Exception as e:
+                    error_msg = f"Error during merging process for {file_type.upper()} PDF files: {e}"
+                    record_error(task_id, error_msg, 'merge')
                     print(f"Task {task_id}: {error_msg}")
                     if file_type in results: del results[file_type]
+            else:
+                error_msg = f"No {file_type.upper()} files were successfully downloaded/found to merge."
+                record_error(task_id, error_msg, 'merge')
+                print(f"Task {task_id}: {error_msg}")
 
+        def collect_analysis(job_index):
+            pdf_file = downloaded_paths[job_index]
+            if pdf_file is None or job_index not in analysis_futures:
+                return None
+            try:
+                try:
+                    analysis, extract_seconds = analysis_futures[job_index].result()
+                except BrokenProcessPool as e:
+                    print(f"Task {task_id}: Text extraction pool failed for {pdf_file.name}: {e}. Retrying in this thread.")
+                    _discard_text_extract_pool()
+                    analysis, extract_seconds = measure_paper_analysis(*analysis_args[job_index])
             except Exception as e:
-                error_msg = f"Error during merging process for {file_type.upper()} PDF files: {e}"
-                tasks_status[task_id]['errors'].append(error_msg)
-                print(f"Task {task_id}: {error_msg}")
-                if file_type in results: del results[file_type]
-        else:
-            error_msg = f"No {file_type.upper()} files were successfully downloaded/found to merge."
-            tasks_status[task_id]['errors'].append(error_msg)
-            print(f"Task {task_id}: {error_msg}")
+                print(f"Task {task_id}: Text extraction failed for {pdf_file.name}: {e}")
+                return None
+            if extract_seconds is None:
+                count_event('analysis_cache_hit', task_id=task_id)
+            else:
+                count_event('analysis_cache_miss', task_id=task_id)
+                record_timing('text_extract', extract_seconds, task_id, analysis['page_count'])
+            return analysis
+
+        ms_alignment = {}
+        if analyze_ms:
+            qp_job_indexes = {download_jobs[job_index]['filename']: job_index for job_index in jobs_by_type['qp']}
+            for job_index in jobs_by_type['ms']:
+                ms_source = download_jobs[job_index]['filename']
+                library_index = library_indexes.get(job_index)
+                if library_index:
+                    # The stored pages are keyed by the library's own question numbering, so they are
+                    # only used when the question paper also comes from the library index
+                    if library_indexes.get(qp_job_indexes.get(question_paper_filename(ms_source))):
+                        count_event('library_index_hit', task_id=task_id)
+                        ms_alignment[ms_source] = {
+                            question['number']: question['ms_pages'] for question in library_index['questions']
+                            if question['number'] is not None and question['ms_pages']
+                        }
+                        continue
+                    analysis_futures[job_index] = analysis_executor.submit(measure_paper_analysis, *analysis_args[job_index])
+                analysis = collect_analysis(job_index)
+                if analysis is not None:
+                    ms_alignment[download_jobs[job_index]['filename']] = {
+                        question['number']: question['pages'] for question in analysis['questions'] if question['number'] is not None
+                    }
+
+        qp_units = None
+        if analyze_qp:
+            qp_units = []
+            for source_index, job_index in enumerate(jobs_by_type['qp']):
+                pdf_file = downloaded_paths[job_index]
+                if pdf_file is None:
+                    continue
+                # Papers indexed by build-library are reused as-is: no text extraction or classification
+                library_index = library_indexes.get(job_index)
+                if library_index:
+                    count_event('library_index_hit', task_id=task_id)
+                    analysis = None
+                    questions = [dict(question, text=None) for question in library_index['questions']]
+                else:
+                    analysis = collect_analysis(job_index)
+                    questions = analysis['questions'] if analysis is not None else None
+                ms_source = mark_scheme_filename(pdf_file.name)
+                if questions is not None:
+                    for question in questions:
+                        unit = {
+                            'source_index': source_index, 'source': pdf_file.name, 'number': question['number'],
+                            'pages': question['pages'], 'text': question['text'],
+                        }
+                        if 'topics' in question:
+                            unit['topics'] = question['topics']
+                        ms_pages = ms_alignment.get(ms_source, {}).get(question['number'])
+                        if ms_pages:
+                            unit['ms_source'] = ms_source
+                            unit['ms_pages'] = ms_pages
+                        qp_units.append(unit)
+                    continue
+                try:
+                    page_count = len(PdfReader(pdf_file).pages)
+                except Exception as e:
+                    error_msg = f"Could not read {pdf_file.name} for topical analysis: {e}"
+                    record_error(task_id, error_msg, 'analysis')
+                    print(f"Task {task_id}: {error_msg}")
+                    continue
+                qp_units.extend(
+                    {'source_index': source_index, 'source': pdf_file.name, 'number': None, 'pages': [page], 'text': None}
+                    for page in range(page_count)
+                )
+
+    set_progress(task_id, 'Download/Merge phase complete. Checking for topical generation.', 'merge', len(file_types_to_process), len(file_types_to_process))
+    get_task_store().update_files(task_id, results)
+    return results, qp_units
+
+def mark_scheme_filename(qp_filename):
+    return qp_filename.replace('_qp_', '_ms_')
+
+def question_paper_filename(ms_filename):
+    return ms_filename.replace('_ms_', '_qp_')
+
+def source_page_loader(task_dir):
+    readers = {}
+
+    def get_source_page(page_key):
+        _, source, page_index = page_key
+        if source not in readers:
+            readers[source] = PdfReader(Path(task_dir) / source)
+        return readers[source].pages[page_index]
+
+    return get_source_page
+
+TOPICAL_OUTPUT_KINDS = {
+    'qp': {'prefix': 'Topical', 'index': 'topic_index.json', 'combined_name': 'All topics (bookmarked)'},
+    'ms': {'prefix': 'Topical_MS', 'index': 'topic_index_ms.json', 'combined_name': 'All topics mark scheme (bookmarked)'},
+}
+
+def safe_topic_filename(subject_code, topic, prefix='Topical'):
+    safe_topic_name = "".join(c if c.isalnum() or c in (' ', '_', '-') else '_' for c in topic).strip().replace(" ", "_")
+    while "__" in safe_topic_name:
+        safe_topic_name = safe_topic_name.replace("__", "_")
+    return f"{prefix}_{subject_code}_{safe_topic_name}.pdf"
 
-    tasks_status[task_id]['progress'] = 'Download/Merge phase complete. Checking for topical generation.'
-    tasks_status[task_id]['files'].update(results)
-    return results
+def describe_page_key(page_key):
+    if isinstance(page_key, tuple):
+        return f"{page_key[-2]} page {page_key[-1]+1}"
+    return f"page {page_key+1}"
 
-def run_create_topical(task_id, merged_qp_path_str, subject_code):
-    tasks_status[task_id]['progress'] = 'Starting topical generation...'
+def _write_topical_pdf(task_id, writer, topic, output_pdf_path, kind='qp'):
+    try:
+        partial_path = output_pdf_path.with_name(f"{output_pdf_path.name}.{uuid.uuid4().hex}.part")
+        with timed('pdf_write', task_id), open(partial_path, "wb") as output_file:
+            writer.write(output_file)
+        os.replace(partial_path, output_pdf_path)
+        print(f"Task {task_id}: Created topical PDF: {output_pdf_path.name}")
+        return {'path': str(output_pdf_path), 'filename': output_pdf_path.name, 'topic': topic, 'kind': kind}
+    except Exception as e:
+        error_msg = f"Error writing PDF file for topic '{topic}': {e}"
+        record_error(task_id, error_msg, 'topical')
+        print(f"Task {task_id}: {error_msg}")
+        return None
+
+def write_topical_pdfs(task_id, subject_code, topic_pages, get_page, output_dir, output_mode='separate', kind='qp', report_progress=True):
+    output_kind = TOPICAL_OUTPUT_KINDS[kind]
+    topics = [topic for topic, page_keys in topic_pages.items() if page_keys]
+    write_separate = output_mode in ('separate', 'both')
+    write_combined = output_mode in ('combined', 'both')
+
+    page_key_topics = {}
+    for topic in topics:
+        for page_key in topic_pages[topic]:
+            page_key_topics.setdefault(page_key, []).append(topic)
+
+    writers = {topic: PdfWriter() for topic in topics} if write_separate else {}
+    loaded_pages = {}
+    if report_progress:
+        set_progress(task_id, f'Collecting {len(page_key_topics)} pages for {len(topics)} topics...')
+    for page_key in sorted(page_key_topics):
+        try:
+            page = get_page(page_key)
+        except Exception as e:
+            record_error(task_id, f"Warning: Could not read {describe_page_key(page_key)} for topical output: {e}. Skipping.", 'topical')
+            print(f"Task {task_id}: Warning - Could not read {describe_page_key(page_key)}: {e}")
+            continue
+        loaded_pages[page_key] = page
+        for topic in page_key_topics[page_key] if write_separate else []:
+            try:
+                writers[topic].add_page(page)
+            except Exception as e:
+                record_error(task_id, f"Error adding {describe_page_key(page_key)} to topic '{topic}': {e}", 'topical')
+                print(f"Task {task_id}: Error adding {describe_page_key(page_key)} to topic '{topic}': {e}")
+
+    topical_files = []
+    for topic_number, topic in enumerate(topics if write_separate else []):
+        writer = writers[topic]
+        if report_progress:
+            progress_percent = int((topic_number / max(1, len(topics))) * 100)
+            set_progress(task_id, f'Creating PDF for topic: {topic}... ({progress_percent}%)', 'topical', topic_number, len(topics))
+        if len(writer.pages) == 0:
+            info_msg = f"No valid pages could be added for topic '{topic}' for subject {subject_code}. PDF not created."
+            record_error(task_id, info_msg, 'topical')
+            print(f"Task {task_id}: {info_msg}")
+            continue
+        print(f"Task {task_id}: Creating PDF for '{topic}' with {len(writer.pages)} pages...")
+        file_record = _write_topical_pdf(
+            task_id, writer, topic, output_dir / safe_topic_filename(subject_code, topic, output_kind['prefix']), kind
+        )
+        if file_record:
+            topical_files.append(file_record)
+
+    if write_combined and loaded_pages:
+        if report_progress:
+            set_progress(task_id, 'Creating combined topical PDF...')
+        combined_writer = PdfWriter()
+        for topic in topics:
+            first_page_number = len(combined_writer.pages)
+            for page_key in sorted(topic_pages[topic]):
+                if page_key in loaded_pages:
+                    try:
+                        combined_writer.add_page(loaded_pages[page_key])
+                    except Exception as e:
+                        record_error(task_id, f"Error adding {describe_page_key(page_key)} to combined topic '{topic}': {e}", 'topical')
+                        print(f"Task {task_id}: Error adding {describe_page_key(page_key)} to combined topic '{topic}': {e}")
+            if len(combined_writer.pages) > first_page_number:
+                combined_writer.add_outline_item(topic, first_page_number)
+        if len(combined_writer.pages) > 0:
+            print(f"Task {task_id}: Creating combined topical PDF with {len(combined_writer.pages)} pages...")
+            file_record = _write_topical_pdf(
+                task_id, combined_writer, output_kind['combined_name'],
+                output_dir / safe_topic_filename(subject_code, 'All_Topics', output_kind['prefix']), kind
+            )
+            if file_record:
+                topical_files.append(file_record)
+
+    return topical_files
+
+def plan_topical_pdfs(task_id, subject_code, topic_pages, output_dir, output_mode='separate', kind='qp'):
+    output_kind = TOPICAL_OUTPUT_KINDS[kind]
+    topics = [topic for topic, page_keys in topic_pages.items() if page_keys]
+    _write_json_atomic(output_dir / output_kind['index'], {
+        'subject_code': subject_code,
+        'topics': {topic: sorted(topic_pages[topic]) for topic in topics},
+    })
+
+    planned_files = []
+    if output_mode in ('separate', 'both'):
+        for topic in topics:
+            filename = safe_topic_filename(subject_code, topic, output_kind['prefix'])
+            planned_files.append({'path': str(output_dir / filename), 'filename': filename, 'topic': topic, 'kind': kind, 'pending': True})
+    if output_mode in ('combined', 'both') and topics:
+        filename = safe_topic_filename(subject_code, 'All_Topics', output_kind['prefix'])
+        planned_files.append({
+            'path': str(output_dir / filename), 'filename': filename, 'topic': output_kind['combined_name'],
+            'kind': kind, 'pending': True, 'combined': True,
+        })
+    print(f"Task {task_id}: Indexed {len(topics)} {kind.upper()} topics; topical PDFs will be written on first download.")
+    return planned_files
+
+def compact_page_topics(page_topics):
+    index = {}
+    for (_, source, page), topics in sorted(page_topics.items()):
+        if topics:
+            index.setdefault(source, {})[page] = sorted(topics)
+    return index
+
+def run_create_topical(task_id, subject_code, task_dir_str, units):
+    set_progress(task_id, 'Starting topical generation...')
     print(f"Task {task_id}: Starting topical generation for subject {subject_code}")
 
     if not PdfReader or not PdfWriter:
         error_msg = "PDF processing library (pypdf) not available."
-        tasks_status[task_id]['errors'].append(error_msg)
-        tasks_status[task_id]['progress'] = f'Error: {error_msg}'
+        record_error(task_id, error_msg)
+        set_progress(task_id, f'Error: {error_msg}')
         return {'topical_files': []}
 
     keyword_map = ALL_KEYWORD_MAPS.get(subject_code)
-    if not keyword_map:
+    keyword_matcher = KEYWORD_MATCHERS.get(subject_code)
+    if not keyword_map or not keyword_matcher:
         info_msg = f"No keyword map available for subject {subject_code}. Skipping topical generation."
-        tasks_status[task_id]['errors'].append(info_msg)
-        tasks_status[task_id]['progress'] = info_msg
+        record_error(task_id, info_msg, 'info')
+        set_progress(task_id, info_msg)
         print(f"Task {task_id}: {info_msg}")
         return {'topical_files': []}
 
-    input_pdf_path = Path(merged_qp_path_str)
-    output_dir = input_pdf_path.parent / "topical"
-
-    if not input_pdf_path.is_file():
-        error_msg = f"Merged QP PDF not found at '{input_pdf_path}' for topical generation."
-        tasks_status[task_id]['errors'].append(error_msg)
-        tasks_status[task_id]['progress'] = 'Error: Input for topical not found.'
-        print(f"Task {task_id}: {error_msg}")
-        return {'topical_files': []}
+    task_dir = Path(task_dir_str)
+    output_dir = task_dir / "topical"
 
     try:
         output_dir.mkdir(parents=True, exist_ok=True)
         print(f"Task {task_id}: Topical output directory: {output_dir.resolve()}")
     except OSError as e:
         error_msg = f"Error creating topical output directory '{output_dir}': {e}"
-        tasks_status[task_id]['errors'].append(error_msg)
-        tasks_status[task_id]['progress'] = 'Error creating topical directory.'
+        record_error(task_id, error_msg, 'topical')
+        set_progress(task_id, 'Error creating topical directory.')
         print(f"Task {task_id}: {error_msg}")
         return {'topical_files': []}
 
     topic_pages = {topic: set() for topic in keyword_map.values()}
-    topical_files_generated = []
+    topic_ms_pages = {topic: set() for topic in keyword_map.values()}
+    page_topics = {}
     pages_processed = 0
-    num_pages = 0
+    num_pages = sum(len(unit['pages']) for unit in units)
 
     try:
-        reader = PdfReader(input_pdf_path)
-        num_pages = len(reader.pages)
-        tasks_status[task_id]['progress'] = f'Analyzing {num_pages} pages for topics...'
-        print(f"Task {task_id}: Analyzing {num_pages} pages in {input_pdf_path.name}")
-
-        for i, page in enumerate(reader.pages):
+        source_count = len({unit['source'] for unit in units})
+        set_progress(task_id, f'Analyzing {len(units)} questions/pages for topics...', 'analysis', 0, num_pages)
+        print(f"Task {task_id}: Analyzing {len(units)} questions/pages across {source_count} papers")
+
+        pages_to_extract = {}
+        for unit in units:
+            if unit['text'] is None and 'topics' not in unit:
+                pages_to_extract.setdefault(unit['source'], []).append(unit['pages'][0])
+        extracted_texts = {}
+        page_errors = {}
+        for source, source_pages in pages_to_extract.items():
+            for i, text, error in extract_pages_text(task_id, task_dir / source, source_pages):
+                extracted_texts[(source, i)] = text
+                if error:
+                    page_errors[(source, i)] = error
+
+        raise_if_cancelled(task_id)
+        for unit_index, unit in enumerate(units):
+            first_page = (unit['source'], unit['pages'][0])
+            text = unit['text'] if unit['text'] is not None else extracted_texts.get(first_page)
+            if text is None and first_page in page_errors:
+                record_error(task_id, f"Warning: Error extracting text from {unit['source']} page {first_page[1]+1}: {page_errors[first_page]}.", 'analysis')
+                print(f"Task {task_id}: Warning - Error extracting text from {unit['source']} page {first_page[1]+1}: {page_errors[first_page]}")
+                continue
             try:
-                text = page.extract_text()
-                if text:
-                    text_lower = text.lower()
-                    page_matched_this_loop = False
-                    for keyword, topic in keyword_map.items():
-                        if keyword in text_lower:
-                            topic_pages[topic].add(i)
-                            page_matched_this_loop = True
-
-                pages_processed += 1
-                if i > 0 and i % 50 == 0:
+                if 'topics' in unit:
+                    # A library built against an older keyword map may name topics that no longer exist
+                    unit_topics = [topic for topic in unit['topics'] if topic in topic_pages]
+                elif text:
+                    with timed('classify', task_id):
+                        unit_topics = classify_question(keyword_matcher, text)
+                else:
+                    unit_topics = None
+                if unit_topics is not None:
+                    for page in unit['pages']:
+                        page_key = (unit['source_index'], unit['source'], page)
+                        for topic in unit_topics:
+                            topic_pages[topic].add(page_key)
+                        page_topics.setdefault(page_key, set()).update(unit_topics)
+                    for page in unit.get('ms_pages', []):
+                        for topic in unit_topics:
+                            topic_ms_pages[topic].add((unit['source_index'], unit['ms_source'], page))
+
+                pages_processed += len(unit['pages'])
+                if unit_index > 0 and unit_index % 50 == 0:
                     progress_percent = int((pages_processed/max(1, num_pages))*100)
-                    tasks_status[task_id]['progress'] = f'Analyzing pages... ({progress_percent}%)'
+                    set_progress(task_id, f'Analyzing pages... ({progress_percent}%)', 'analysis', pages_processed, num_pages)
 
             except Exception as e:
-                tasks_status[task_id]['errors'].append(f"Warning: Error extracting text from page {i+1}: {e}.")
-                print(f"Task {task_id}: Warning - Error extracting text from page {i+1}: {e}")
+                record_error(task_id, f"Warning: Error classifying {unit['source']} page {first_page[1]+1}: {e}.", 'analysis')
+                print(f"Task {task_id}: Warning - Error classifying {unit['source']} page {first_page[1]+1}: {e}")
 
-        tasks_status[task_id]['progress'] = f'Page analysis complete. Found potential matches for {len([t for t, p in topic_pages.items() if p])} topics.'
+        set_progress(
+            task_id, f'Page analysis complete. Found potential matches for {len([t for t, p in topic_pages.items() if p])} topics.',
+            'analysis', pages_processed, num_pages
+        )
         print(f"Task {task_id}: Page analysis complete.")
 
-        topics_created_count = 0
         total_topics_with_pages = len([t for t, p in topic_pages.items() if p])
 
         if total_topics_with_pages == 0:
-            info_msg = f"No keywords from the map for {subject_code} were matched in the merged PDF. No topical files generated."
-            tasks_status[task_id]['errors'].append(info_msg)
+            info_msg = f"No keywords from the map for {subject_code} were matched in the question papers. No topical files generated."
+            record_error(task_id, info_msg, 'info')
             print(f"Task {task_id}: {info_msg}")
         else:
             print(f"Task {task_id}: Found pages for {total_topics_with_pages} topics. Starting PDF creation...")
 
-        for topic, page_indices in topic_pages.items():
-            if page_indices:
-                sorted_indices = sorted(list(page_indices))
-                writer = PdfWriter()
-                progress_percent = int((topics_created_count / max(1, total_topics_with_pages)) * 100)
-                tasks_status[task_id]['progress'] = f'Creating PDF for topic: {topic}... ({progress_percent}%)'
-                print(f"Task {task_id}: Creating PDF for '{topic}' with {len(sorted_indices)} pages...")
-
-                for page_index in sorted_indices:
-                    if 0 <= page_index < num_pages:
-                        try:
-                            writer.add_page(reader.pages[page_index])
-                        except Exception as e:
-                            tasks_status[task_id]['errors'].append(f"Error adding page {page_index+1} to topic '{topic}': {e}")
-                            print(f"Task {task_id}: Error adding page {page_index+1} to topic '{topic}': {e}")
-                    else:
-                        tasks_status[task_id]['errors'].append(f"Warning: Invalid page index {page_index+1} encountered for topic '{topic}'. Skipping.")
-                        print(f"Task {task_id}: Warning - Invalid page index {page_index+1} for topic '{topic}'.")
-
-                if len(writer.pages) > 0:
-                    safe_topic_name = "".join(c if c.isalnum() or c in (' ', '_', '-') else '_' for c in topic).strip().replace(" ", "_")
-                    while "__" in safe_topic_name:
-                        safe_topic_name = safe_topic_name.replace("__", "_")
-                    output_pdf_filename = f"Topical_{subject_code}_{safe_topic_name}.pdf"
-                    output_pdf_path = output_dir / output_pdf_filename
-
-                    try:
-                        with open(output_pdf_path, "wb") as output_file:
-                            writer.write(output_file)
-                        topical_files_generated.append({'path': str(output_pdf_path), 'filename': output_pdf_filename, 'topic': topic})
-                        topics_created_count += 1
-                        print(f"Task {task_id}: Created topical PDF: {output_pdf_filename}")
-                    except Exception as e:
-                        error_msg = f"Error writing PDF file for topic '{topic}': {e}"
-                        tasks_status[task_id]['errors'].append(error_msg)
-                        print(f"Task {task_id}: {error_msg}")
-                else:
-                    info_msg = f"No valid pages could be added for topic '{topic}' for subject {subject_code}. PDF not created."
-                    tasks_status[task_id]['errors'].append(info_msg)
-                    print(f"Task {task_id}: {info_msg}")
-
-        tasks_status[task_id]['progress'] = f'Topical generation finished. {topics_created_count} files created.'
+        raise_if_cancelled(task_id)
+        topical_outputs = {'qp': [], 'ms': []}
+        for kind, kind_topic_pages in (('qp', topic_pages), ('ms', topic_ms_pages)):
+            if not any(kind_topic_pages.values()):
+                continue
+            if app.config['LAZY_ARTIFACTS']:
+                topical_outputs[kind] = plan_topical_pdfs(
+                    task_id, subject_code, kind_topic_pages, output_dir, app.config['TOPICAL_OUTPUT_MODE'], kind
+                )
+            else:
+                topical_outputs[kind] = write_topical_pdfs(
+                    task_id, subject_code, kind_topic_pages, source_page_loader(task_dir), output_dir,
+                    app.config['TOPICAL_OUTPUT_MODE'], kind
+                )
+        topical_files_generated = topical_outputs['qp']
+        topics_created_count = len(topical_outputs['qp']) + len(topical_outputs['ms'])
+
+        set_progress(task_id, f'Topical generation finished. {topics_created_count} files created.')
         print(f"Task {task_id}: Topical generation finished. Created {topics_created_count} files.")
-        return {'topical_files': topical_files_generated}
+        return {
+            'topical_files': topical_files_generated,
+            'topical_ms_files': topical_outputs['ms'],
+            'page_topics': compact_page_topics(page_topics),
+        }
 
-    except FileNotFoundError:
-        error_msg = f"Error: Input PDF file not found at '{input_pdf_path}' during topical generation."
-        tasks_status[task_id]['errors'].append(error_msg)
-        tasks_status[task_id]['progress'] = 'Error: Input file disappeared.'
+    except TaskCancelled:
+        raise
+    except FileNotFoundError as e:
+        error_msg = f"Error: Source paper not found during topical generation: {e}"
+        record_error(task_id, error_msg, 'topical')
+        set_progress(task_id, 'Error: Input file disappeared.')
         print(f"Task {task_id}: {error_msg}")
         return {'topical_files': []}
     except Exception as e:
         error_msg = f"An unexpected error occurred during topical PDF creation for {subject_code}: {e}"
-        tasks_status[task_id]['errors'].append(error_msg)
-        tasks_status[task_id]['progress'] = 'Error during topical generation.'
+        record_error(task_id, error_msg, 'topical')
+        set_progress(task_id, 'Error during topical generation.')
         print(f"Task {task_id}: {error_msg}")
         import traceback
         traceback.print_exc()
         return {'topical_files': []}
 
 def background_task_runner(task_id, subject_code, paper_number, start_year, end_year, sessions, include_ms, generate_topical):
+    start_task_metrics(task_id)
+    started = time.perf_counter()
     try:
-        merge_results = run_download_and_merge(
-            task_id, subject_code, paper_number, start_year, end_year, sessions, include_ms
+        merge_results, qp_units = run_download_and_merge(
+            task_id, subject_code, paper_number, start_year, end_year, sessions, include_ms,
+            analyze_qp=generate_topical and subject_code in ALL_KEYWORD_MAPS
         )
 
-        if tasks_status[task_id].get('status') == 'Error':
+        if get_task_store().get_status(task_id) == 'Error':
             print(f"Task {task_id}: Halting after critical merge error.")
             return
-
-        merged_qp_info = tasks_status[task_id]['files'].get('qp')
+        raise_if_cancelled(task_id)
 
         topical_results = {'topical_files': []}
         if generate_topical:
-            if merged_qp_info and merged_qp_info.get('path'):
-                merged_qp_path = merged_qp_info['path']
-                topical_results = run_create_topical(task_id, merged_qp_path, subject_code)
+            if qp_units:
+                task_dir = Path(app.config['GENERATED_FILE_DIR']) / task_id
+                topical_results = run_create_topical(task_id, subject_code, str(task_dir), qp_units)
             else:
-                info_msg = "Topical generation skipped: Merged Question Paper file was not successfully created or found."
-                tasks_status[task_id]['errors'].append(info_msg)
-                tasks_status[task_id]['progress'] = 'Topical generation skipped (No QP).'
+                info_msg = "Topical generation skipped: No Question Paper files were successfully downloaded or analysed."
+                record_error(task_id, info_msg, 'info')
+                set_progress(task_id, 'Topical generation skipped (No QP).')
                 print(f"Task {task_id}: {info_msg}")
         else:
-            tasks_status[task_id]['progress'] = 'Topical generation not requested.'
+            set_progress(task_id, 'Topical generation not requested.')
             print(f"Task {task_id}: Topical generation not requested.")
 
-        tasks_status[task_id]['files']['topical'] = topical_results.get('topical_files', [])
+        get_task_store().update_files(task_id, {
+            'topical': topical_results.get('topical_files', []),
+            'topical_ms': topical_results.get('topical_ms_files', []),
+        })
 
-        if tasks_status[task_id].get('status') != 'Error':
-            tasks_status[task_id]['status'] = 'Completed'
-            tasks_status[task_id]['progress'] = 'All tasks finished.'
+        if get_task_store().get_status(task_id) == 'Processing':
+            get_task_store().update(task_id, status='Completed', progress='All tasks finished.')
             print(f"Task {task_id}: Completed successfully.")
 
+    except TaskCancelled:
+        set_progress(task_id, 'Cancelled.')
+        print(f"Task {task_id}: Cancelled.")
     except Exception as e:
         error_msg = f"Critical error in background task runner {task_id}: {e}"
         print(error_msg)
         import traceback
         traceback.print_exc()
-        tasks_status[task_id]['status'] = 'Error'
-        tasks_status[task_id]['errors'].append(error_msg)
-        tasks_status[task_id]['progress'] = 'Critical error encountered.'
+        get_task_store().update(task_id, status='Error', progress='Critical error encountered.')
+        record_error(task_id, error_msg)
+    finally:
+        record_timing('task', time.perf_counter() - started, task_id)
+        count_event(f"tasks_{(get_task_store().get_status(task_id) or 'removed').lower()}", task_id=task_id)
+        finish_task_metrics(task_id)
+
+TASK_PARAM_KEYS = ('subject', 'paper', 'start_year', 'end_year', 'sessions', 'ms', 'topical')
+
+class TaskCancelled(Exception):
+    pass
+
+class QueueFullError(Exception):
+    pass
+
+def task_cancelled(task_id):
+    return get_task_store().get_status(task_id) == 'Cancelled'
+
+def raise_if_cancelled(task_id):
+    if task_cancelled(task_id):
+        raise TaskCancelled(task_id)
+
+def run_scheduled_task(task_id, params):
+    if task_cancelled(task_id):
+        set_progress(task_id, 'Cancelled.')
+        print(f"Task {task_id}: Cancelled before it started.")
+        return
+    try:
+        args = [params[key] for key in TASK_PARAM_KEYS]
+    except KeyError as e:
+        get_task_store().update(task_id, status='Error', progress='Could not start task.', queue_position=None)
+        record_error(task_id, f"Task parameters are incomplete ({e}); please submit the request again.")
+        return
+    background_task_runner(task_id, *args)
+
+class JobScheduler:
+    """Runs tasks on a fixed pool of worker threads fed from a bounded queue.
+
+    Waiting tasks are queued per client and dequeued round-robin, so a client
+    with several submissions cannot push everyone else to the back. Queue
+    positions are written to the task store whenever the queue changes.
+    Clients are keyed by request.remote_addr; behind a reverse proxy, wrap
+    app.wsgi_app in werkzeug's ProxyFix so that it is the real address.
+    """
+
+    def __init__(self, workers, max_queued, max_queued_per_client):
+        self.workers = max(1, workers)
+        self.max_queued = max_queued
+        self.max_queued_per_client = max_queued_per_client
+        self._queues = {}
+        self._running = set()
+        self._threads = []
+        self._condition = threading.Condition()
+        self._publish_lock = threading.Lock()
+
+    def submit(self, task_id, params, client=None, force=False):
+        with self._condition:
+            if not force:
+                if sum(len(queue) for queue in self._queues.values()) >= self.max_queued:
+                    raise QueueFullError("The server is busy right now. Please try again in a few minutes.")
+                if len(self._queues.get(client, ())) >= self.max_queued_per_client:
+                    raise QueueFullError(
+                        f"You already have {self.max_queued_per_client} requests waiting. "
+                        "Please wait for one of them to start before submitting another."
+                    )
+            self._queues.setdefault(client, deque()).append((task_id, params, time.monotonic()))
+            while len(self._threads) < self.workers:
+                thread = Thread(target=self._worker, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._condition.notify()
+        self.publish_positions()
+
+    def _queued_order(self):
+        queues = list(self._queues.values())
+        order = []
+        depth = 0
+        while any(depth < len(queue) for queue in queues):
+            order.extend(queue[depth][0] for queue in queues if depth < len(queue))
+            depth += 1
+        return order
+
+    def _next_job(self):
+        with self._condition:
+            while not self._queues:
+                self._condition.wait()
+            client = next(iter(self._queues))
+            queue = self._queues.pop(client)
+            task_id, params, queued_at = queue.popleft()
+            if queue:
+                self._queues[client] = queue
+            self._running.add(task_id)
+        return task_id, params, queued_at
+
+    def _worker(self):
+        while True:
+            task_id, params, queued_at = self._next_job()
+            self.publish_positions()
+            start_task_metrics(task_id)
+            record_timing('queue_wait', time.monotonic() - queued_at, task_id)
+            try:
+                run_scheduled_task(task_id, params)
+            except Exception as e:
+                print(f"Task {task_id}: Scheduler worker error: {e}")
+            finally:
+                finish_task_metrics(task_id)
+                with self._condition:
+                    self._running.discard(task_id)
+
+    def cancel_queued(self, task_id):
+        with self._condition:
+            for client, queue in self._queues.items():
+                job = next((job for job in queue if job[0] == task_id), None)
+                if job is not None:
+                    queue.remove(job)
+                    if not queue:
+                        del self._queues[client]
+                    break
+            else:
+                return False
+        self.publish_positions()
+        return True
+
+    def tracked_task_ids(self):
+        with self._condition:
+            return self._running | {task_id for queue in self._queues.values() for task_id, *_ in queue}
+
+    def depth(self):
+        """Returns (queued, running) job counts."""
+        with self._condition:
+            return sum(len(queue) for queue in self._queues.values()), len(self._running)
+
+    def publish_positions(self):
+        with self._publish_lock:
+            with self._condition:
+                order = self._queued_order()
+            task_store = get_task_store()
+            for position, task_id in enumerate(order, 1):
+                task_store.update(task_id, queue_position=position, progress=f'Queued: position {position} of {len(order)}.')
+
+def get_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = JobScheduler(app.config['JOB_WORKERS'], app.config['JOB_QUEUE_MAX'], app.config['JOB_QUEUE_MAX_PER_CLIENT'])
+        return _scheduler
+
+def task_fingerprint(params):
+    canonical = {key: params[key] for key in TASK_PARAM_KEYS}
+    canonical['paper'] = str(int(params['paper']))
+    canonical['sessions'] = sorted(set(params['sessions']))
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode()).hexdigest()
+
+def client_id():
+    """A random id kept in the session cookie; tasks record which clients subscribed to them."""
+    if 'client_id' not in session:
+        session['client_id'] = uuid.uuid4().hex
+    return session['client_id']
+
+def request_task_cancellation(task_id, client):
+    """Returns 'cancelled', 'detached' when other clients still share the task, or None."""
+    task_store = get_task_store()
+    if task_store.get_status(task_id) not in TASK_RUNNING_STATUSES:
+        return None
+    if task_store.detach(task_id, client) > 0:
+        return 'detached'
+    if get_scheduler().cancel_queued(task_id):
+        task_store.update(task_id, status='Cancelled', progress='Cancelled before starting.', queue_position=None)
+    else:
+        task_store.update(task_id, status='Cancelled', progress='Cancelling...', queue_position=None)
+    return 'cancelled'
+
+def _task_recovery_loop():
+    last_recovery = None
+    while True:
+        task_store = get_task_store()
+        try:
+            # Held-back progress reaches other workers within one flush interval
+            task_store.flush()
+            if last_recovery is None or time.monotonic() - last_recovery >= app.config['TASK_RECOVERY_INTERVAL']:
+                last_recovery = time.monotonic()
+                for task_id in get_scheduler().tracked_task_ids():
+                    task_store.update(task_id)
+
+                for task_id, params in task_store.claim_stale_tasks(app.config['TASK_STALE_AFTER']):
+                    get_scheduler().submit(task_id, params, client='recovered', force=True)
+                    print(f"Task {task_id}: Requeued interrupted task for {params.get('subject')} {params.get('paper')} {params.get('years')}")
+        except Exception as e:
+            print(f"Task recovery error: {e}")
+        time.sleep(min(app.config['TASK_PROGRESS_FLUSH_INTERVAL'], app.config['TASK_RECOVERY_INTERVAL']))
+
+@app.before_request
+def ensure_task_recovery():
+    global _task_recovery_thread
+    with _task_store_lock:
+        if _task_recovery_thread is None:
+            _task_recovery_thread = Thread(target=_task_recovery_loop, daemon=True)
+            _task_recovery_thread.start()
+
+def directory_size(path):
+    """Bytes that deleting path would free; files also linked from the paper cache are not counted."""
+    size = 0
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                file_stat = os.stat(os.path.join(root, filename))
+            except OSError:
+                continue
+            if file_stat.st_nlink == 1:
+                size += file_stat.st_size
+    return size
+
+def is_task_id(name):
+    try:
+        return str(uuid.UUID(name)) == name
+    except ValueError:
+        return False
+
+def remove_task(task_id):
+    """Deletes a task's record, then its directory. Returns (whether the task was tracked, bytes freed, or
+    None if it had no directory); raises OSError if the directory could not be removed."""
+    if task_id in ('', '.', '..'):
+        return False, None
+    task_dir = Path(app.config['GENERATED_FILE_DIR']) / task_id
+    tracked = get_task_store().delete(task_id)
+    forget_artifact_locks(task_id)
+    if not task_dir.is_dir():
+        return tracked, None
+    freed = directory_size(task_dir)
+    shutil.rmtree(task_dir)
+    return tracked, freed
+
+def disk_usage_fraction(path):
+    usage = shutil.disk_usage(path)
+    return usage.used / usage.total if usage.total else 0.0
+
+def run_janitor(now=None):
+    """Removes finished tasks not updated within TASK_TTL, then, while the disk holding GENERATED_FILE_DIR
+    is above TASK_DISK_HIGH_WATERMARK, the oldest remaining finished tasks until it is below
+    TASK_DISK_LOW_WATERMARK.
+
+    Queued and running tasks are never removed. The TTL is at least TASK_REUSE_WINDOW, so a completed task
+    stays available to identical submissions for the whole window unless the disk fills up; records are
+    deleted before directories, so a later submission starts a new task rather than attaching to a
+    removed one. Task directories without a record are removed once older than the TTL, but are left
+    alone under disk pressure since they may belong to another worker process with its own store.
+    """
+    now = time.time() if now is None else now
+    generated_dir = Path(app.config['GENERATED_FILE_DIR'])
+    expire_before = now - max(app.config['TASK_TTL'], app.config['TASK_REUSE_WINDOW'])
+    task_store = get_task_store()
+    report = {'expired': 0, 'evicted': 0, 'orphaned': 0, 'bytes_freed': 0}
+
+    def remove(task_id, reason):
+        try:
+            _, freed = remove_task(task_id)
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            print(f"Janitor: Could not remove task {task_id}: {e}")
+            return
+        report[reason] += 1
+        report['bytes_freed'] += freed or 0
+
+    finished = task_store.finished_tasks()
+    for task_id, updated_at in finished:
+        if updated_at < expire_before:
+            remove(task_id, 'expired')
+
+    try:
+        task_dirs = [entry for entry in generated_dir.iterdir() if entry.is_dir() and is_task_id(entry.name)]
+    except OSError as e:
+        print(f"Janitor: Could not list {generated_dir}: {e}")
+        task_dirs = []
+    for task_dir in task_dirs:
+        try:
+            expired = task_dir.stat().st_mtime < expire_before
+        except OSError:
+            continue
+        if expired and not task_store.exists(task_dir.name):
+            remove(task_dir.name, 'orphaned')
+
+    high_watermark = app.config['TASK_DISK_HIGH_WATERMARK']
+    if high_watermark and disk_usage_fraction(generated_dir) >= high_watermark:
+        for task_id, updated_at in finished:
+            if disk_usage_fraction(generated_dir) <= app.config['TASK_DISK_LOW_WATERMARK']:
+                break
+            if updated_at >= expire_before:
+                remove(task_id, 'evicted')
+        else:
+            print(f"Janitor: Disk is {disk_usage_fraction(generated_dir):.0%} full and no finished tasks are left to remove.")
+
+    if report['expired'] or report['evicted'] or report['orphaned']:
+        print(
+            f"Janitor: Removed {report['expired']} expired, {report['evicted']} evicted and {report['orphaned']} orphaned "
+            f"tasks, freeing {report['bytes_freed'] / (1024 * 1024):.1f} MB."
+        )
+    return report
+
+def _janitor_loop():
+    while True:
+        try:
+            run_janitor()
+        except Exception as e:
+            print(f"Janitor error: {e}")
+        time.sleep(app.config['JANITOR_INTERVAL'])
+
+@app.before_request
+def ensure_janitor():
+    global _janitor_thread
+    with _task_store_lock:
+        if _janitor_thread is None and app.config['JANITOR_INTERVAL']:
+            _janitor_thread = Thread(target=_janitor_loop, daemon=True)
+            _janitor_thread.start()
+
+def _artifact_lock(task_id, artifact_name):
+    with _artifact_locks_lock:
+        return _artifact_locks.setdefault((task_id, artifact_name), threading.Lock())
+
+def forget_artifact_locks(task_id):
+    with _artifact_locks_lock:
+        for lock_key in [lock_key for lock_key in _artifact_locks if lock_key[0] == task_id]:
+            del _artifact_locks[lock_key]
+
+def materialize_merged_pdf(task_id, file_info):
+    with _artifact_lock(task_id, file_info['filename']):
+        if not file_info.get('pending'):
+            return True
+
+        output_filepath = Path(file_info['path'])
+        print(f"Task {task_id}: Merging {len(file_info['sources'])} files into {file_info['filename']} on first download...")
+        merger = PdfMerger()
+        try:
+            for source in file_info['sources']:
+                try:
+                    with timed('merge', task_id):
+                        merger.append(str(output_filepath.parent / source))
+                except Exception as merge_err:
+                    error_msg = f"Could not append file {source} to {file_info['filename']}: {merge_err}. Skipping."
+                    record_error(task_id, error_msg, 'merge')
+                    print(f"Task {task_id}: {error_msg}")
+
+            if len(merger.pages) == 0:
+                error_msg = f"No valid pages found/appended to merge for {file_info['filename']}."
+                record_error(task_id, error_msg, 'merge')
+                print(f"Task {task_id}: {error_msg}")
+                return False
+
+            partial_path = output_filepath.with_name(f"{output_filepath.name}.{uuid.uuid4().hex}.part")
+            with timed('pdf_write', task_id):
+                merger.write(str(partial_path))
+            os.replace(partial_path, output_filepath)
+        except Exception as e:
+            error_msg = f"Error during merging process for {file_info['filename']}: {e}"
+            record_error(task_id, error_msg, 'merge')
+            print(f"Task {task_id}: {error_msg}")
+            return False
+        finally:
+            merger.close()
+
+        file_info['pending'] = False
+        print(f"Task {task_id}: Successfully merged {file_info['filename']}")
+        return True
+
+def materialize_topical_pdf(task_id, file_info):
+    with _artifact_lock(task_id, file_info['filename']):
+        if not file_info.get('pending'):
+            return True
+
+        output_dir = Path(file_info['path']).parent
+        kind = file_info.get('kind', 'qp')
+        try:
+            with open(output_dir / TOPICAL_OUTPUT_KINDS[kind]['index']) as f:
+                topic_index = json.load(f)
+        except (OSError, ValueError) as e:
+            error_msg = f"Topic index for {file_info['filename']} could not be read: {e}"
+            record_error(task_id, error_msg, 'topical')
+            print(f"Task {task_id}: {error_msg}")
+            return False
+
+        all_topic_pages = {topic: {tuple(page_key) for page_key in page_keys} for topic, page_keys in topic_index['topics'].items()}
+        if file_info.get('combined'):
+            topic_pages, output_mode = all_topic_pages, 'combined'
+        else:
+            topic_pages, output_mode = {file_info['topic']: all_topic_pages.get(file_info['topic'], set())}, 'separate'
+
+        print(f"Task {task_id}: Writing {file_info['filename']} on first download...")
+        # The task has already finished, so its progress is left alone
+        written_files = write_topical_pdfs(
+            task_id, topic_index['subject_code'], topic_pages, source_page_loader(output_dir.parent), output_dir, output_mode, kind,
+            report_progress=False
+        )
+        if not any(written['filename'] == file_info['filename'] for written in written_files):
+            return False
+        file_info['pending'] = False
+        return True
+
+def materialize_artifact(task_id, file_info, file_key, index=None):
+    if not file_info.get('pending'):
+        return True
+    if Path(file_info['path']).is_file():
+        materialized = True  # Written by another worker; artifacts only appear once complete.
+    elif 'sources' in file_info:
+        materialized = materialize_merged_pdf(task_id, file_info)
+    else:
+        materialized = materialize_topical_pdf(task_id, file_info)
+    if materialized:
+        get_task_store().update_file_record(task_id, file_key, {'pending': False}, index)
+    return materialized
+
+def artifact_etag(task_id, file_path, file_info, file_key, index=None):
+    """Returns the SHA-256 of a generated file, hashing it only when it changed since the digest was stored."""
+    stat = file_path.stat()
+    if file_info.get('sha256') and file_info.get('size') == stat.st_size and file_info.get('mtime_ns') == stat.st_mtime_ns:
+        return file_info['sha256']
+    sha256 = file_sha256(file_path)
+    get_task_store().update_file_record(
+        task_id, file_key, {'sha256': sha256, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}, index
+    )
+    return sha256
+
+def send_artifact(file_path, download_name, etag):
+    """Serves a generated PDF with a strong ETag, answering If-None-Match and Range requests.
+
+    With X_ACCEL_REDIRECT_PREFIX set (an internal nginx location aliased to GENERATED_FILE_DIR) or
+    USE_X_SENDFILE enabled, only headers are sent and the front proxy transfers the file itself.
+    """
+    accel_prefix = app.config['X_ACCEL_REDIRECT_PREFIX']
+    if not accel_prefix:
+        return send_file(file_path, mimetype='application/pdf', as_attachment=True, download_name=download_name, etag=etag)
+    relative_path = file_path.relative_to(app.config['GENERATED_FILE_DIR']).as_posix()
+    response = Response(mimetype='application/pdf')
+    response.headers['X-Accel-Redirect'] = f"{accel_prefix.rstrip('/')}/{quote(relative_path)}"
+    response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+def _library_index_path(output_dir, subject_code, filename):
+    return Path(output_dir) / subject_code / f"{Path(filename).stem}.json"
+
+def load_library_index(subject_code, filename, sha256=None, ms_sha256=None):
+    """Returns the build-library index for question paper filename if it was built with the
+    current PAPER_ANALYSIS_VERSION from these exact files (sha256 for the question paper,
+    ms_sha256 for its mark scheme; either may be left out), otherwise None."""
+    try:
+        with open(_library_index_path(app.config['TOPICAL_LIBRARY_DIR'], subject_code, filename)) as f:
+            library_index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if library_index.get('version') != PAPER_ANALYSIS_VERSION:
+        return None
+    if (sha256 is not None and library_index.get('sha256') != sha256) or \
+            (ms_sha256 is not None and library_index.get('ms_sha256') != ms_sha256):
+        return None
+    return library_index
+
+def build_topical_library(subject_codes, paper_numbers, years, sessions, include_ms=True, output_dir=None, task_id='library'):
+    """Downloads and analyses every paper in the given ranges into the paper and analysis
+    caches, then writes one index per question paper under output_dir listing each
+    question's pages, topics and mark scheme pages.
+
+    Later web requests for the same papers are served from those caches, so they skip
+    downloading entirely, and use the index in place of question paper classification
+    and mark scheme segmentation when TOPICAL_LIBRARY_DIR points at output_dir.
+    """
+    output_dir = Path(output_dir or app.config['TOPICAL_LIBRARY_DIR'])
+    file_types = ['qp', 'ms'] if include_ms else ['qp']
+    summary = Counter()
+    get_task_store().create(task_id, 'Processing', 'Building topical library...', {})
+
+    cache_dir = _paper_cache_dir()
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix='library_', dir=cache_dir) as staging_dir:
+        download_jobs = []
+        for subject_code in subject_codes:
+            if subject_code not in KEYWORD_MATCHERS:
+                print(f"Library: No keyword map for {subject_code}; its papers are cached but not indexed.")
+            for paper_number in paper_numbers:
+                download_jobs.extend(paper_download_jobs(
+                    subject_code, paper_number, years, sessions, file_types, staging_dir
+                ))
+        print(f"Library: Fetching {len(download_jobs)} papers with {app.config['DOWNLOAD_WORKERS']} workers...")
+
+        analysis_futures = {}
+        with ThreadPoolExecutor(max_workers=max(1, app.config['DOWNLOAD_WORKERS'])) as executor, \
+                ThreadPoolExecutor(max_workers=max(1, app.config['ANALYSIS_WORKERS'])) as analysis_executor:
+            futures = {executor.submit(download_paper, task_id, job['source_path'], job['path']): job for job in download_jobs}
+            for future in as_completed(futures):
+                job = futures[future]
+                pdf_path, job['sha256'] = future.result()
+                if pdf_path is None:
+                    summary['unavailable'] += 1
+                    continue
+                summary['fetched'] += 1
+                if job['subject_code'] in KEYWORD_MATCHERS:
+                    extract_executor = get_text_extract_pool() or analysis_executor
+                    analysis_futures[job['filename']] = extract_executor.submit(
+                        load_paper_analysis, str(pdf_path), job['sha256'], str(cache_dir), job['file_type']
+                    )
+
+            analyses = {}
+            for filename, analysis_future in analysis_futures.items():
+                try:
+                    analyses[filename] = analysis_future.result()
+                except BrokenProcessPool as e:
+                    print(f"Library: Text extraction pool failed for {filename}: {e}")
+                    _discard_text_extract_pool()
+                except Exception as e:
+                    print(f"Library: Text extraction failed for {filename}: {e}")
+                if filename not in analyses:
+                    summary['analysis_failed'] += 1
+
+    jobs_by_filename = {job['filename']: job for job in download_jobs}
+    for job in download_jobs:
+        if job['file_type'] != 'qp' or job['filename'] not in analyses:
+            continue
+        keyword_matcher = KEYWORD_MATCHERS[job['subject_code']]
+        ms_source = mark_scheme_filename(job['filename'])
+        ms_analysis = analyses.get(ms_source)
+        ms_alignment = {
+            question['number']: question['pages'] for question in ms_analysis['questions'] if question['number'] is not None
+        } if ms_analysis else {}
+
+        questions = []
+        for question in analyses[job['filename']]['questions']:
+            question_topics = classify_question(keyword_matcher, question['text'])
+            questions.append({
+                'number': question['number'], 'pages': question['pages'], 'topics': question_topics,
+                'ms_pages': ms_alignment.get(question['number'], []),
+            })
+
+        _write_json_atomic(_library_index_path(output_dir, job['subject_code'], job['filename']), {
+            'version': PAPER_ANALYSIS_VERSION,
+            'source': job['filename'],
+            'sha256': job['sha256'],
+            'ms_source': ms_source if ms_analysis else None,
+            'ms_sha256': jobs_by_filename[ms_source].get('sha256') if ms_analysis else None,
+            'questions': questions,
+        })
+        summary['indexed'] += 1
+
+    errors = get_task_store().get(task_id)['errors']
+    get_task_store().update(task_id, status='Completed', progress='Topical library built.')
+    print(
+        f"Library: {summary['fetched']} papers cached, {summary['unavailable']} unavailable, "
+        f"{summary['indexed']} question papers indexed, {summary['analysis_failed']} could not be analysed. Index: {output_dir}"
+    )
+    return {'summary': dict(summary), 'errors': errors, 'output_dir': str(output_dir)}
+
+def render_index(**form_values):
+    """Renders the request form, refilled with form_values when re-showing a submission."""
+    topical_available_subjects = {
+        code: SUBJECT_NAMES.get(code, f"Unknown Subject {code}")
+        for code in ALL_KEYWORD_MAPS.keys() if code in SUBJECT_NAMES
+    }
+    return render_template('index.html',
+                           subjects=SUBJECT_NAMES,
+                           topical_available_subjects=topical_available_subjects,
+                           **form_values)
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'GET':
-        topical_available_subjects = {
-            code: SUBJECT_NAMES.get(code, f"Unknown Subject {code}")
-            for code in ALL_KEYWORD_MAPS.keys() if code in SUBJECT_NAMES
-        }
-        return render_template('index.html',
-                               subjects=SUBJECT_NAMES,
-                               topical_available_subjects=topical_available_subjects)
+        return render_index()
 
     if request.method == 'POST':
         try:
@@ -707,29 +3171,39 @@ def index():
             if errors:
                 for error in errors:
                     flash(error, "danger")
-                topical_available_subjects = { code: SUBJECT_NAMES.get(code, f"Unknown Subject {code}") for code in ALL_KEYWORD_MAPS.keys() if code in SUBJECT_NAMES }
-                return render_template('index.html',
-                                        subjects=SUBJECT_NAMES,
-                                        topical_available_subjects=topical_available_subjects,
-                                        selected_subject=subject_code,
-                                        entered_paper=paper_number,
-                                        entered_years=year_range,
-                                        selected_sessions=session_input,
-                                        checked_ms=include_ms,
-                                        checked_topical=generate_topical and subject_code in ALL_KEYWORD_MAPS
-                                        )
-
-            task_id = str(uuid.uuid4())
-            tasks_status[task_id] = {'status': 'Queued', 'progress': 'Initializing...', 'files': {}, 'errors': [], 'params': {
-                'subject': subject_code, 'paper': paper_number, 'years': year_range, 'sessions': sessions, 'ms': include_ms, 'topical': generate_topical
-            }}
-
-            thread = Thread(target=background_task_runner, args=(
-                task_id, subject_code, paper_number, start_year, end_year, sessions, include_ms, generate_topical
-            ))
-            thread.daemon = True
-            thread.start()
-            print(f"Task {task_id}: Started background thread for {subject_code} {paper_number} {year_range}")
+                return render_index(selected_subject=subject_code,
+                                    entered_paper=paper_number,
+                                    entered_years=year_range,
+                                    selected_sessions=session_input,
+                                    checked_ms=include_ms,
+                                    checked_topical=generate_topical and subject_code in ALL_KEYWORD_MAPS)
+
+            params = {
+                'subject': subject_code, 'paper': paper_number, 'years': year_range, 'start_year': start_year, 'end_year': end_year,
+                'sessions': sessions, 'ms': include_ms, 'topical': generate_topical
+            }
+            new_task_id = str(uuid.uuid4())
+            task_id = get_task_store().attach_or_create(
+                new_task_id, 'Queued', 'Initializing...', params, task_fingerprint(params),
+                time.time() - app.config['TASK_REUSE_WINDOW'], client_id()
+            )
+            if task_id != new_task_id:
+                flash("The same papers were requested recently, so you have been attached to that request.", "info")
+                print(f"Task {task_id}: Attached identical request for {subject_code} {paper_number} {year_range}")
+                return redirect(url_for('task_status', task_id=task_id))
+
+            try:
+                get_scheduler().submit(task_id, params, client=request.remote_addr)
+            except QueueFullError as e:
+                get_task_store().delete(task_id)
+                flash(str(e), "warning")
+                return render_index(selected_subject=subject_code,
+                                    entered_paper=paper_number,
+                                    entered_years=year_range,
+                                    selected_sessions=session_input,
+                                    checked_ms=include_ms,
+                                    checked_topical=generate_topical), 503
+            print(f"Task {task_id}: Queued {subject_code} {paper_number} {year_range}")
 
             return redirect(url_for('task_status', task_id=task_id))
 
@@ -742,22 +3216,138 @@ def index():
 
 @app.route('/status/<task_id>')
 def task_status(task_id):
-    status_info = tasks_status.get(task_id)
+    status_info = get_task_store().get(task_id)
     if not status_info:
         flash(f"Task ID '{task_id}' not found.", "warning")
         return redirect(url_for('index'))
     return render_template('status.html', status=status_info, task_id=task_id)
 
+def compact_task_files(files):
+    compact = {}
+    for file_key in ('qp', 'ms'):
+        if files.get(file_key):
+            compact[file_key] = {'filename': files[file_key]['filename']}
+    for file_key in ('topical', 'topical_ms'):
+        if files.get(file_key):
+            compact[file_key] = [{'topic': file_info['topic'], 'filename': file_info['filename']} for file_info in files[file_key]]
+    return compact
+
+def task_status_view(record):
+    """The client-facing part of a task record: no server paths, page lists or error messages."""
+    counter = record['counters'].get(record['stage']) if record['stage'] else None
+    return {
+        'status': record['status'],
+        'progress': record['progress'],
+        'percent': int(counter['done'] * 100 / counter['total']) if counter and counter['total'] else None,
+        'stage': record['stage'],
+        'counters': record['counters'],
+        'queue_position': record['queue_position'],
+        'files': compact_task_files(record['files']),
+        'error_counts': record['error_counts'],
+        'metrics': record['metrics'],
+    }
+
+def dropped_error_count(errors, since):
+    """Number of errors after since that were pushed out of the error log before errors[0]."""
+    return errors[0]['seq'] - since - 1 if errors else 0
+
 @app.route('/status_api/<task_id>')
 def task_status_api(task_id):
-    status_info = tasks_status.get(task_id)
-    if not status_info:
+    task_store = get_task_store()
+    record = task_store.get(task_id, include_errors=False)
+    if not record:
+        return jsonify({"status": "Error", "message": "Task not found"}), 404
+    since = max(0, request.args.get('since', 0, type=int))
+    errors = task_store.get_errors(task_id, since)
+    status_view = task_status_view(record)
+    status_view.update({
+        'errors': errors, 'errors_dropped': dropped_error_count(errors, since),
+        'cursor': errors[-1]['seq'] if errors else max(since, record['error_seq']),
+    })
+    return jsonify(status_view)
+
+@app.route('/metrics')
+def metrics():
+    queued, running = _scheduler.depth() if _scheduler is not None else (0, 0)
+    with _task_metrics_lock:
+        active_tasks = len(_task_metrics)
+    gauges = {
+        'queue_depth': ("Tasks waiting in the job queue.", queued),
+        'jobs_running': ("Tasks running on scheduler workers.", running),
+        'tasks_active': ("Tasks being processed in this process.", active_tasks),
+    }
+    return Response(_metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+def format_sse(data, event=None, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event:
+        lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+def parse_stream_cursor(cursor):
+    """Returns the error sequence number from a '<version>-<error seq>' stream cursor."""
+    try:
+        return max(0, int(cursor.rsplit('-', 1)[1]))
+    except (AttributeError, IndexError, ValueError):
+        return 0
+
+@app.route('/status_stream/<task_id>')
+def task_status_stream(task_id):
+    task_store = get_task_store()
+    if not task_store.exists(task_id):
         return jsonify({"status": "Error", "message": "Task not found"}), 404
-    return jsonify(status_info)
+    error_cursor = parse_stream_cursor(request.headers.get('Last-Event-ID') or request.args.get('cursor'))
+
+    def events():
+        nonlocal error_cursor
+        sent = {}
+        seen_version = None
+        started = last_sent = time.monotonic()
+        yield "retry: 2000\n\n"
+        while True:
+            record = task_store.get(task_id, include_errors=False)
+            if record is None:
+                yield format_sse({"status": "Error", "message": "Task not found"}, event='end')
+                return
+
+            status_view = task_status_view(record)
+            changes = {
+                field: value for field, value in status_view.items()
+                if field not in sent or sent[field] != value
+            }
+            sent.update(changes)
+            if record['version'] != seen_version:
+                new_errors = task_store.get_errors(task_id, error_cursor)
+                if new_errors:
+                    changes.update({'errors': new_errors, 'errors_dropped': dropped_error_count(new_errors, error_cursor)})
+                    error_cursor = new_errors[-1]['seq']
+                seen_version = record['version']
+            if changes:
+                changes['cursor'] = error_cursor
+                yield format_sse(changes, event_id=f"{record['version']}-{error_cursor}")
+                last_sent = time.monotonic()
+
+            if record['status'] in TASK_TERMINAL_STATUSES:
+                yield format_sse({"status": record['status']}, event='end')
+                return
+            if time.monotonic() - started >= app.config['STATUS_STREAM_MAX_DURATION']:
+                return
+            if time.monotonic() - last_sent >= app.config['STATUS_STREAM_KEEPALIVE']:
+                yield ": keepalive\n\n"
+                last_sent = time.monotonic()
+            task_store.wait_for_change(task_id, app.config['STATUS_STREAM_POLL_INTERVAL'])
+
+    return Response(
+        stream_with_context(events()), mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 @app.route('/download/<task_id>/<file_key>')
 def download_file(task_id, file_key):
-    status_info = tasks_status.get(task_id)
+    status_info = get_task_store().get(task_id)
     if not status_info or status_info.get('status') == 'Queued':
         flash("Task not found or not started processing.", "danger")
         return redirect(url_for('task_status', task_id=task_id))
@@ -766,6 +3356,7 @@ def download_file(task_id, file_key):
     base_directory = Path(app.config['GENERATED_FILE_DIR']) / task_id
     file_path_to_serve = None
     filename_to_serve = None
+    record_key = record_index = None
 
     if file_key == 'merged_qp' and status_info.get('files', {}).get('qp'):
         file_info = status_info['files']['qp']
@@ -775,6 +3366,9 @@ def download_file(task_id, file_key):
             if not str(file_path_to_serve.parent) == str(base_directory):
                 print(f"Security warning: Attempt to download file outside task dir: {file_path_to_serve}")
                 file_path_to_serve = None
+            elif not materialize_artifact(task_id, file_info, 'qp'):
+                file_path_to_serve = None
+            record_key, record_index = 'qp', None
 
     elif file_key == 'merged_ms' and status_info.get('files', {}).get('ms'):
         file_info = status_info['files']['ms']
@@ -784,11 +3378,19 @@ def download_file(task_id, file_key):
             if not str(file_path_to_serve.parent) == str(base_directory):
                 print(f"Security warning: Attempt to download file outside task dir: {file_path_to_serve}")
                 file_path_to_serve = None
+            elif not materialize_artifact(task_id, file_info, 'ms'):
+                file_path_to_serve = None
+            record_key, record_index = 'ms', None
 
     elif file_key.startswith('topical_'):
         try:
-            index = int(file_key.split('_')[1])
-            topical_files = status_info.get('files', {}).get('topical', [])
+            if file_key.startswith('topical_ms_'):
+                index = int(file_key[len('topical_ms_'):])
+                topical_key = 'topical_ms'
+            else:
+                index = int(file_key.split('_')[1])
+                topical_key = 'topical'
+            topical_files = status_info.get('files', {}).get(topical_key, [])
             if 0 <= index < len(topical_files):
                 file_info = topical_files[index]
                 if file_info and 'path' in file_info and 'filename' in file_info:
@@ -798,6 +3400,9 @@ def download_file(task_id, file_key):
                     if not str(file_path_to_serve.parent) == str(expected_parent):
                         print(f"Security warning: Attempt to download topical file outside task/topical dir: {file_path_to_serve}")
                         file_path_to_serve = None
+                    elif not materialize_artifact(task_id, file_info, topical_key, index):
+                        file_path_to_serve = None
+                    record_key, record_index = topical_key, index
 
         except (ValueError, IndexError):
             pass
@@ -805,11 +3410,8 @@ def download_file(task_id, file_key):
     if file_path_to_serve and filename_to_serve and file_path_to_serve.is_file():
         try:
             print(f"Task {task_id}: Serving file '{filename_to_serve}' from directory '{file_path_to_serve.parent}'")
-            return send_from_directory(
-                directory=file_path_to_serve.parent,
-                path=filename_to_serve,
-                as_attachment=True
-            )
+            etag = artifact_etag(task_id, file_path_to_serve, file_info, record_key, record_index)
+            return send_artifact(file_path_to_serve, filename_to_serve, etag)
         except Exception as e:
             flash(f"Error serving file '{filename_to_serve}': {e}", "danger")
             print(f"Download error for {task_id}/{file_key}: {e}")
@@ -819,24 +3421,35 @@ def download_file(task_id, file_key):
         print(f"Task {task_id}: File download failed - File key '{file_key}', Path '{file_path_to_serve}', Filename '{filename_to_serve}'")
         return redirect(url_for('task_status', task_id=task_id))
 
+@app.route('/cancel/<task_id>', methods=['POST'])
+def cancel_task(task_id):
+    outcome = request_task_cancellation(task_id, client_id())
+    if outcome == 'detached':
+        flash(f"Stopped waiting for task {task_id}. It keeps running for other users who requested the same papers.", "info")
+        return redirect(url_for('index'))
+    if outcome == 'cancelled':
+        flash(f"Task {task_id} cancelled.", "info")
+    elif get_task_store().exists(task_id):
+        flash(f"Task {task_id} has already finished and cannot be cancelled.", "warning")
+    else:
+        flash(f"Task ID '{task_id}' not found.", "warning")
+    return redirect(url_for('task_status', task_id=task_id))
+
 @app.route('/cleanup/<task_id>', methods=['POST'])
 def cleanup_task(task_id):
-    task_dir = Path(app.config['GENERATED_FILE_DIR']) / task_id
-    task_exists_in_status = task_id in tasks_status
-
-    if task_exists_in_status:
-        try:
-            del tasks_status[task_id]
-        except KeyError: pass
+    if get_task_store().detach(task_id, client_id()) > 0:
+        flash(f"Removed task {task_id} from your requests. Its files are kept for other users who requested the same papers.", "info")
+        return redirect(url_for('index'))
+    try:
+        task_exists_in_status, freed = remove_task(task_id)
+    except OSError as e:
+        flash(f"Error cleaning up files for task {task_id}: {e}", "danger")
+        print(f"Cleanup error for {task_id}: {e}")
+        return redirect(url_for('index'))
 
-    if task_dir.exists() and task_dir.is_dir():
-        try:
-            shutil.rmtree(task_dir)
-            flash(f"Cleaned up files for task {task_id}.", "success")
-            print(f"Task {task_id}: Cleaned up directory {task_dir}")
-        except OSError as e:
-            flash(f"Error cleaning up files for task {task_id}: {e}", "danger")
-            print(f"Cleanup error for {task_id}: {e}")
+    if freed is not None:
+        flash(f"Cleaned up files for task {task_id}.", "success")
+        print(f"Task {task_id}: Cleaned up directory, freeing {freed} bytes")
     elif task_exists_in_status:
         flash(f"Task {task_id} removed from tracking. No files/directory found to clean up.", "info")
     else:
@@ -844,11 +3457,50 @@ def cleanup_task(task_id):
 
     return redirect(url_for('index'))
 
+def parse_year_range(value):
+    try:
+        start_year, end_year = (int(part) for part in value.split('-'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid year range '{value}', use YYYY-YYYY (e.g. 2018-2023)")
+    if start_year > end_year:
+        raise argparse.ArgumentTypeError(f"invalid year range '{value}', start year is after end year")
+    return list(range(start_year, end_year + 1))
+
+def parse_paper_number(value):
+    if not value.isdigit() or not (1 <= int(value) <= 9):
+        raise argparse.ArgumentTypeError(f"invalid paper number '{value}', use a single digit")
+    return value
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Past paper merger and topical generator.")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('serve', help="Run the Flask development server (default).")
+    library_parser = subparsers.add_parser('build-library', help="Download, analyse and index papers ahead of time.")
+    library_parser.add_argument('--subjects', nargs='+', choices=list(SUBJECT_NAMES), default=list(SUBJECT_NAMES))
+    library_parser.add_argument('--papers', nargs='+', type=parse_paper_number, default=['1', '2', '3', '4'])
+    library_parser.add_argument('--years', type=parse_year_range, default='2018-2024', help="Year range, e.g. 2018-2024.")
+    library_parser.add_argument('--sessions', nargs='+', choices=['m', 's', 'w'], default=['m', 's', 'w'])
+    library_parser.add_argument('--no-ms', action='store_true', help="Skip mark schemes.")
+    library_parser.add_argument('--output', help="Index directory (default: TOPICAL_LIBRARY_DIR).")
+    library_parser.add_argument(
+        '--source', action='append',
+        help="Paper source URL or local mirror directory; repeat to set the fallback order (default: PAPER_SOURCES)."
+    )
+    return parser
+
 if __name__ == '__main__':
+    args = build_arg_parser().parse_args()
     if not PdfMerger or not PdfReader or not PdfWriter:
         print("\nERROR: Required PDF libraries (PyPDF2 and pypdf) are not installed.")
         print("Please install them:")
         print("pip install pypdf2 pypdf requests Flask")
+    elif args.command == 'build-library':
+        app.config['TASK_STORE'] = 'memory'
+        if args.source:
+            app.config['PAPER_SOURCES'] = args.source
+        library = build_topical_library(args.subjects, args.papers, args.years, args.sessions, not args.no_ms, args.output)
+        for error in library['errors']:
+            print(f"  {error['message']}")
     else:
         try:
             os.makedirs(app.config['GENERATED_FILE_DIR'], exist_ok=True)
@@ -863,5 +3515,5 @@ if __name__ == '__main__':
 
             @app.route("/status_api/<task_id>")
             def status_api(task_id):
-                status = tasks_status.get(task_id, {"status": "Unknown", "progress": "N/A", "files": {}})
+                status = get_task_store().get(task_id) or {"status": "Unknown", "progress": "N/A", "files": {}}
                 return jsonify(status)
@@ -1,39 +1,117 @@
-// Auto-refresh task status every 5 seconds
-function pollTaskStatus(taskId) {
-  const statusBox = document.getElementById("status-box");
-  const progressBox = document.getElementById("progress-box");
+// Live task status: Server-Sent Events, falling back to polling /status_api
+const TERMINAL_STATUSES = ["Completed", "Error", "Cancelled"];
+
+function updateProgressBar(percent) {
+  const bar = document.getElementById("progress-bar");
+  if (bar && percent !== null && percent !== undefined) {
+    bar.style.width = percent + "%";
+    bar.setAttribute("aria-valuenow", percent);
+    bar.textContent = percent + "%";
+  }
+}
+
+function renderFiles(taskId, files) {
   const filesBox = document.getElementById("files-box");
+  filesBox.innerHTML = "";
+  if (files.qp) {
+    filesBox.innerHTML += `<a class="btn btn-success m-1" href="/download/${taskId}/merged_qp">Download Merged QP</a>`;
+  }
+  if (files.ms) {
+    filesBox.innerHTML += `<a class="btn btn-success m-1" href="/download/${taskId}/merged_ms">Download Merged MS</a>`;
+  }
+  if (files.topical && files.topical.length) {
+    filesBox.innerHTML += "<h5>Topical Files</h5><ul>";
+    files.topical.forEach((file, idx) => {
+      filesBox.innerHTML += `<li><a href="/download/${taskId}/topical_${idx}">${file.topic}</a></li>`;
+    });
+    filesBox.innerHTML += "</ul>";
+  }
+  if (files.topical_ms && files.topical_ms.length) {
+    filesBox.innerHTML += "<h5>Topical Mark Schemes</h5><ul>";
+    files.topical_ms.forEach((file, idx) => {
+      filesBox.innerHTML += `<li><a href="/download/${taskId}/topical_ms_${idx}">${file.topic}</a></li>`;
+    });
+    filesBox.innerHTML += "</ul>";
+  }
+}
+
+function appendErrors(errors, dropped) {
+  const errorsBox = document.getElementById("errors-box");
+  if (!errorsBox) return;
+  const messages = errors.map((error) => error.message);
+  if (dropped) {
+    messages.unshift(`(${dropped} earlier messages not shown)`);
+  }
+  messages.forEach((message) => {
+    const item = document.createElement("li");
+    item.textContent = message;
+    errorsBox.appendChild(item);
+  });
+}
+
+function applyStatusUpdate(taskId, data) {
+  if (data.status !== undefined) {
+    document.getElementById("status-box").textContent = data.status;
+  }
+  if (data.progress !== undefined) {
+    document.getElementById("progress-box").textContent = data.progress;
+  }
+  if (data.percent !== undefined) {
+    updateProgressBar(data.percent);
+  }
+  if (data.files) {
+    renderFiles(taskId, data.files);
+  }
+  if (data.errors) {
+    appendErrors(data.errors, data.errors_dropped);
+  }
+  if (TERMINAL_STATUSES.includes(data.status)) {
+    const cancelForm = document.getElementById("cancel-form");
+    if (cancelForm) cancelForm.remove();
+  }
+}
+
+// errorCursor is the sequence number of the last error already on the page
+function watchTaskStatus(taskId, errorCursor) {
+  if (!window.EventSource) {
+    pollTaskStatus(taskId, errorCursor);
+    return;
+  }
+  const source = new EventSource(`/status_stream/${taskId}?cursor=0-${errorCursor}`);
+
+  source.onmessage = (event) => {
+    const data = JSON.parse(event.data);
+    errorCursor = data.cursor;
+    applyStatusUpdate(taskId, data);
+  };
+  source.addEventListener("end", (event) => {
+    source.close();
+    applyStatusUpdate(taskId, JSON.parse(event.data));
+  });
+  source.onerror = () => {
+    // EventSource reconnects by itself (resuming from the last event id); if the
+    // server refused the stream altogether, fall back to polling.
+    if (source.readyState === EventSource.CLOSED) {
+      pollTaskStatus(taskId, errorCursor);
+    }
+  };
+}
+
+function pollTaskStatus(taskId, errorCursor = 0) {
+  const progressBox = document.getElementById("progress-box");
 
   async function fetchStatus() {
     try {
-      const response = await fetch(`/status_api/${taskId}`);
+      // Only errors recorded after the cursor are returned
+      const response = await fetch(`/status_api/${taskId}?since=${errorCursor}`);
       if (!response.ok) throw new Error("Network response was not ok");
       const data = await response.json();
 
-      // Update status and progress
-      statusBox.textContent = data.status;
-      progressBox.textContent = data.progress;
-
-      // Update file links if available
-      if (data.files) {
-        filesBox.innerHTML = "";
-        if (data.files.qp) {
-          filesBox.innerHTML += `<a class="btn btn-success m-1" href="/download/${taskId}/merged_qp">Download Merged QP</a>`;
-        }
-        if (data.files.ms) {
-          filesBox.innerHTML += `<a class="btn btn-success m-1" href="/download/${taskId}/merged_ms">Download Merged MS</a>`;
-        }
-        if (data.files.topical) {
-          filesBox.innerHTML += "<h5>Topical Files</h5><ul>";
-          data.files.topical.forEach((file, idx) => {
-            filesBox.innerHTML += `<li><a href="/download/${taskId}/topical_${idx}">${file.topic}</a></li>`;
-          });
-          filesBox.innerHTML += "</ul>";
-        }
-      }
+      errorCursor = data.cursor;
+      applyStatusUpdate(taskId, data);
 
       // Keep polling until finished
-      if (data.status !== "Completed" && data.status !== "Error") {
+      if (!TERMINAL_STATUSES.includes(data.status)) {
         setTimeout(fetchStatus, 5000);
       }
     } catch (err) {